@@ -0,0 +1,369 @@
+# Nearest neighbour index over the cover embeddings of embed.py, for "books with covers like the ones I
+# liked" suggestions. The vectors are normalized, so the inner product is the cosine similarity. The exact
+# search is a blocked matrix multiplication over all the vectors, the IVF search only scans the inverted
+# lists of the nprobe nearest k-means centroids. The lists are stored contiguously and memory-mapped, the
+# embeddings added later go into a small delta segment, which is searched exactly until the next rebuild
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+import embedding_store
+from kmeans import MiniBatchKMeans, CentroidIndex
+import shared
+
+EMBEDDINGS_NAME = 'cover-cnn'
+RESULT_FILE = 'similar.json'
+RESULT_SIZE = 20
+BLOCK_SIZE = 16384
+NPROBE = 8
+# Smaller indexes are searched exactly
+MIN_IVF_SIZE = 10000
+KMEANS_PASSES = 5
+# The delta segment is merged by a rebuild when it grows over this share of the index
+REBUILD_SHARE = 0.1
+
+
+def index_folder(name):
+    return name + '.index'
+
+
+def normalize(matrix):
+    matrix = np.array(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+def top_k(scores, k):
+    """ Column indexes of the k highest scores of every row, highest first
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((len(scores), 0), dtype=np.int64)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def exact_search(vectors, queries, k, skip=None, block_size=BLOCK_SIZE):
+    """ (scores, rows) of the k rows with the highest inner product for every query, shape (queries, k).
+    The rows where skip is True get a -inf score
+    """
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        scores = queries @ np.asarray(vectors[start:start + block_size], dtype=np.float32).T
+        if skip is not None:
+            scores[:, skip[start:start + block_size]] = -np.inf
+        top = top_k(scores, k)
+        scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+        rows = np.concatenate([best_rows, top + start], axis=1)
+        top = top_k(scores, k)
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_rows = np.take_along_axis(rows, top, axis=1)
+    return best_scores, best_rows
+
+
+class VectorIndex():
+    """ The main segment: vectors (float16, normalized) grouped by inverted list, rows offsets[i]:offsets[i + 1]
+    belong to centroids[i], no centroids for an exact index. The delta segment: vectors added since the build
+    """
+
+    def __init__(self, ids, vectors, centroids=None, offsets=None, delta_ids=(), delta=None, meta=None):
+        self.ids = list(ids)
+        self.vectors = vectors
+        self.centroids = centroids
+        self.offsets = offsets
+        self.delta_ids = list(delta_ids)
+        self.delta = np.zeros((0, vectors.shape[1]), dtype=np.float16) if delta is None else delta
+        self.meta = meta or {}
+        self._rows = None
+        self._main_rows = None
+
+    @classmethod
+    def build(cls, ids, matrix, nlist=None, exact=False, meta=None, seed=42):
+        started = time.perf_counter()
+        vectors = np.empty(matrix.shape, dtype=np.float16)
+        for start in range(0, len(matrix), BLOCK_SIZE):
+            vectors[start:start + BLOCK_SIZE] = normalize(matrix[start:start + BLOCK_SIZE])
+
+        if exact or len(vectors) < MIN_IVF_SIZE:
+            print('built exact index', vectors.shape, f'in {time.perf_counter() - started:.1f}s')
+            return cls(ids, vectors, meta=meta)
+
+        nlist = nlist or int(np.sqrt(len(vectors)))
+        random = np.random.RandomState(seed)
+
+        def batches():
+            order = random.permutation(len(vectors))
+            for start in range(0, len(order), BLOCK_SIZE):
+                yield vectors[np.sort(order[start:start + BLOCK_SIZE])].astype(np.float32)
+
+        trainer = MiniBatchKMeans(nlist, seed=seed).fit(batches, max_passes=KMEANS_PASSES)
+        # unit centroids: the nearest centroid is also the one with the highest inner product
+        centroids = normalize(trainer.centroids)
+        assigner = CentroidIndex(centroids)
+        labels = np.concatenate([assigner.assign(vectors[start:start + BLOCK_SIZE])[0] for start in range(0, len(vectors), BLOCK_SIZE)])
+
+        order = np.argsort(labels, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))]).astype(np.int64)
+        print('built ivf index', vectors.shape, 'lists', nlist, f'in {time.perf_counter() - started:.1f}s')
+        return cls([ids[i] for i in order], vectors[order], centroids, offsets, meta=meta)
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'vectors.npy'), self.vectors)
+        with open(os.path.join(folder, 'ids.json'), 'w') as f:
+            json.dump(self.ids, f)
+        for name in ['centroids', 'offsets']:
+            path = os.path.join(folder, name + '.npy')
+            if getattr(self, name) is not None:
+                np.save(path, getattr(self, name))
+            elif os.path.isfile(path):
+                os.remove(path)
+        self.save_delta(folder)
+        self.save_meta(folder)
+
+    def save_meta(self, folder):
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump({**self.meta, 'size': len(self.ids), 'dim': self.vectors.shape[1]}, f, indent=2)
+
+    def save_delta(self, folder):
+        np.save(os.path.join(folder, 'delta.npy'), self.delta)
+        with open(os.path.join(folder, 'delta.ids.json'), 'w') as f:
+            json.dump(self.delta_ids, f)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        def array(name):
+            path = os.path.join(folder, name + '.npy')
+            return np.load(path, mmap_mode='r' if mmap else None) if os.path.isfile(path) else None
+
+        def ids(name):
+            with open(os.path.join(folder, name)) as f:
+                return json.load(f)
+
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        # the delta is small and changes, it is not memory-mapped
+        return cls(ids('ids.json'), array('vectors'), array('centroids'), array('offsets'),
+                   ids('delta.ids.json'), np.load(os.path.join(folder, 'delta.npy')), meta)
+
+    def __len__(self):
+        return len(self.rows())
+
+    def rows(self):
+        """ Dict id -> (segment, row), the delta overrides the main segment
+        """
+        if self._rows is None:
+            self._rows = {id: ('main', row) for row, id in enumerate(self.ids)}
+            self._rows.update({id: ('delta', row) for row, id in enumerate(self.delta_ids)})
+        return self._rows
+
+    def _main_row(self, id):
+        """ Row of the id in the main segment, [] when it is only in the delta
+        """
+        if self._main_rows is None:
+            self._main_rows = {id: row for row, id in enumerate(self.ids)}
+        return self._main_rows.get(id, [])
+
+    def add(self, ids, matrix):
+        """ Adds the vectors to the delta segment, replacing the earlier vectors of the same ids
+        """
+        vectors = normalize(matrix).astype(np.float16)
+        delta_rows = {id: row for row, id in enumerate(self.delta_ids)}
+        appended_ids = []
+        appended = []
+        for id, vector in zip(ids, vectors):
+            if id in delta_rows:
+                self.delta[delta_rows[id]] = vector
+            else:
+                appended_ids.append(id)
+                appended.append(vector)
+        if appended:
+            self.delta = np.concatenate([self.delta, np.array(appended, dtype=np.float16)])
+            self.delta_ids.extend(appended_ids)
+        self._rows = None
+
+    def vectors_of(self, ids):
+        """ Normalized float32 vectors of the ids
+        """
+        rows = self.rows()
+        return np.array([(self.vectors if rows[id][0] == 'main' else self.delta)[rows[id][1]] for id in ids], dtype=np.float32)
+
+    def _ivf_search(self, queries, k, nprobe, skip):
+        probes = top_k(queries @ self.centroids.T, nprobe)
+        candidates = [[] for _ in queries]
+        # every probed list is scanned once, for all the queries that probe it
+        for list_index in np.unique(probes):
+            start, end = int(self.offsets[list_index]), int(self.offsets[list_index + 1])
+            if start == end:
+                continue
+            probing = np.flatnonzero((probes == list_index).any(axis=1))
+            scores = queries[probing] @ np.asarray(self.vectors[start:end], dtype=np.float32).T
+            scores[:, skip[start:end]] = -np.inf
+            top = top_k(scores, k)
+            for i, query in enumerate(probing):
+                candidates[query].append((scores[i, top[i]], top[i] + start))
+
+        result = []
+        for found in candidates:
+            if not found:
+                result.append((np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)))
+                continue
+            scores = np.concatenate([x for x, _ in found])
+            rows = np.concatenate([x for _, x in found])
+            top = top_k(scores[None], k)[0]
+            result.append((scores[top], rows[top]))
+        return result
+
+    def search(self, queries, k, nprobe=NPROBE, exclude=()):
+        """ List of [(id, score)] with the k most similar vectors for every query, without the excluded ids
+        """
+        queries = normalize(queries)
+        rows = self.rows()
+        # the excluded vectors and the main vectors replaced by the delta are never returned
+        skip = {'main': np.zeros(len(self.ids), dtype=bool), 'delta': np.zeros(len(self.delta_ids), dtype=bool)}
+        for id in self.delta_ids:
+            skip['main'][self._main_row(id)] = True
+        for id in exclude:
+            if id in rows:
+                segment, row = rows[id]
+                skip[segment][row] = True
+
+        if self.centroids is None:
+            main = list(zip(*exact_search(self.vectors, queries, k, skip['main'])))
+        else:
+            main = self._ivf_search(queries, k, nprobe, skip['main'])
+        delta = list(zip(*exact_search(self.delta, queries, k, skip['delta']))) if len(self.delta) else [((), ())] * len(queries)
+
+        result = []
+        for (main_scores, main_rows), (delta_scores, delta_rows) in zip(main, delta):
+            found = [(self.ids[row], float(score)) for score, row in zip(main_scores, main_rows)]
+            found += [(self.delta_ids[row], float(score)) for score, row in zip(delta_scores, delta_rows)]
+            found = [x for x in found if x[1] > -np.inf]
+            found.sort(key=lambda x: -x[1])
+            result.append(found[:k])
+        return result
+
+    def similar(self, ids, k, nprobe=NPROBE, exclude=(), mode='max'):
+        """ [(id, score)] of the k vectors most similar to a group of ids. max: the highest similarity to
+        any of them, mean: the similarity to their mean vector
+        """
+        ids = [x for x in ids if x in self.rows()]
+        if not ids:
+            return []
+        queries = self.vectors_of(ids)
+        if mode == 'mean':
+            return self.search(queries.mean(axis=0, keepdims=True), k, nprobe, exclude)[0]
+
+        best = {}
+        for found in self.search(queries, k, nprobe, exclude):
+            for id, score in found:
+                if score > best.get(id, -np.inf):
+                    best[id] = score
+        return sorted(best.items(), key=lambda x: -x[1])[:k]
+
+
+def changed_rows(index, ids, matrix, block_size=BLOCK_SIZE):
+    """ Rows of the embeddings of ids already in the index whose vector differs from the indexed one
+    """
+    known = index.rows()
+    rows = np.array([row for row, id in enumerate(ids) if id in known], dtype=np.int64)
+    changed = []
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        current = normalize(matrix[block]).astype(np.float16)
+        indexed = index.vectors_of([ids[row] for row in block]).astype(np.float16)
+        changed.extend(block[np.any(current != indexed, axis=1)].tolist())
+    return changed
+
+
+def sync(name=EMBEDDINGS_NAME, folder=None, rebuild=False, nlist=None, exact=False):
+    """ The index of the embeddings, built when missing or when the model or the preprocessing changed.
+    Otherwise, when the embeddings were written again, the new and the changed embeddings go to the delta,
+    which is merged when it is too large
+    """
+    folder = folder or index_folder(name)
+    ids, matrix = embedding_store.load(name)
+    store_meta = embedding_store.load_meta(name)
+    meta = {'model': store_meta.get('model'), 'preprocessing': store_meta.get('preprocessing'), 'exact': exact,
+            'version': embedding_store.version(name)}
+
+    index = None
+    if not rebuild and os.path.isfile(os.path.join(folder, 'meta.json')):
+        index = VectorIndex.load(folder)
+        if any(index.meta.get(x) != meta[x] for x in ['model', 'preprocessing', 'exact']) or index.vectors.shape[1] != matrix.shape[1]:
+            print('embeddings model or preprocessing changed, rebuilding')
+            index = None
+
+    if index is not None:
+        if index.meta.get('version') == meta['version']:
+            return index
+        # the embeddings were written again, embed.py recalculates the ones of the changed covers
+        known = index.rows()
+        new = [row for row, id in enumerate(ids) if id not in known]
+        changed = changed_rows(index, ids, matrix)
+        if new or changed:
+            rows = np.array(new + changed, dtype=np.int64)
+            index.add([ids[row] for row in rows], matrix[rows])
+            print('added to index', len(new), 'changed', len(changed))
+        index.meta = {**index.meta, **meta}
+        if len(index.delta_ids) <= REBUILD_SHARE * max(len(index.ids), MIN_IVF_SIZE):
+            index.save_delta(folder)
+            index.save_meta(folder)
+            return index
+        print('delta too large, rebuilding')
+
+    index = VectorIndex.build(ids, matrix, nlist, exact, meta)
+    index.save(folder)
+    return VectorIndex.load(folder)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Similar covers')
+    parser.add_argument('--embeddings', default=EMBEDDINGS_NAME, help='name of the embeddings saved by embed.py')
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--exact', action='store_true', help='exact search instead of the inverted lists')
+    parser.add_argument('--nlist', type=int, help='number of inverted lists, sqrt of the number of covers by default')
+    parser.add_argument('--nprobe', type=int, default=NPROBE)
+    parser.add_argument('--like', default='true', choices=['true', 'false'], help='suggest covers like the books with this label')
+    parser.add_argument('--id', action='append', help='suggest covers like these books instead')
+    parser.add_argument('--mode', default='max', choices=['max', 'mean'])
+    parser.add_argument('--data', default=shared.DB_FILE)
+    parser.add_argument('--result', default=RESULT_FILE)
+    parser.add_argument('--result_size', type=int, default=RESULT_SIZE)
+    args = parser.parse_args()
+
+    index = sync(args.embeddings, rebuild=args.rebuild, nlist=args.nlist, exact=args.exact)
+    print('index size', len(index))
+
+    books = shared.load_columns(args.data, ['id', 'name', 'label'])
+    names = {str(id): name for id, name in zip(books['id'], books['name'])}
+    labeled = {str(id) for id, label in zip(books['id'], books['label']) if label is not None}
+    if args.id:
+        query = args.id
+    else:
+        like = args.like == 'true'
+        query = [str(id) for id, label in zip(books['id'], books['label']) if label is not None and bool(label) == like]
+    print('query covers', len([x for x in query if x in index.rows()]))
+
+    started = time.perf_counter()
+    found = index.similar(query, args.result_size, args.nprobe, exclude=labeled | set(query), mode=args.mode)
+    print(f'searched in {1000 * (time.perf_counter() - started):.1f}ms')
+
+    result = [{'id': id, 'name': names.get(id), 'score': score} for id, score in found]
+    for entry in result:
+        print(f"{entry['score']:.3f}", entry['id'], entry['name'])
+    with open(args.result, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('saved', args.result)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
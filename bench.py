@@ -0,0 +1,322 @@
+# Benchmark of the image pipeline on synthetic covers: time per stage (read, decode and resize, forward pass,
+# writing the result), images/sec and peak memory of the cover scoring, the embeddings and the BoVW features,
+# across batch sizes and thread counts. Runs offline, the models get random weights when the pretrained
+# ones are not downloaded yet. Every configuration runs in its own process, the results go to a JSON file
+# with a stable layout, so the files of two commits can be diffed
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from io import BytesIO
+from PIL import Image
+
+BENCH_FOLDER = os.path.join('.', 'bench')
+RESULT_FILE = 'bench.json'
+COUNT = 256
+TASKS = ['scoring', 'embedding', 'bovw']
+BATCH_SIZES = [8, 32]
+THREADS = [1, os.cpu_count() or 1]
+# Cover sizes and JPEG quality close to the scraped covers
+COVER_WIDTHS = (300, 420)
+COVER_RATIO = (1.3, 1.5)
+JPEG_QUALITY = 90
+CODEBOOK_SIZE = 200
+
+
+def synthetic_cover(random):
+    """ JPEG with smooth color areas, edges and noise, so it compresses and has keypoints like a real cover
+    """
+    width = random.randint(*COVER_WIDTHS)
+    height = int(width * random.uniform(*COVER_RATIO))
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.empty((height, width, 3), dtype=np.float32)
+    for channel in range(3):
+        fx, fy, phase = random.uniform(1, 6, size=3)
+        image[..., channel] = 127 + 80 * np.sin(x / width * fx * np.pi + phase) * np.cos(y / height * fy * np.pi)
+    for _ in range(random.randint(5, 15)):
+        x0, y0 = random.randint(0, width - 20), random.randint(0, height - 20)
+        image[y0:y0 + random.randint(10, 120), x0:x0 + random.randint(10, 120)] = random.randint(0, 255, size=3)
+    image += random.normal(0, 12, size=image.shape)
+
+    output = BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(output, 'JPEG', quality=JPEG_QUALITY)
+    return output.getvalue()
+
+
+def generate(folder, count, seed=42):
+    """ files/ with count base64 covers like the scraper writes them, and covers/ with the same covers packed
+    """
+    import base64
+    import cover_store
+
+    files_folder = os.path.join(folder, 'files')
+    os.makedirs(files_folder, exist_ok=True)
+    random = np.random.RandomState(seed)
+    sizes = []
+    for id in range(count):
+        data = synthetic_cover(random)
+        sizes.append(len(data))
+        path = os.path.join(files_folder, str(id))
+        if not os.path.isfile(path):
+            with open(path, 'wb') as f:
+                f.write(base64.b64encode(data))
+    cover_store.migrate(files_folder, os.path.join(folder, 'covers'))
+    print('covers', count, 'mean size', f'{np.mean(sizes) / 1024:.1f} KB')
+
+
+def peak_rss_mb():
+    """ Peak memory of this process or of the largest of its finished child processes (the workers of a pool,
+    after it was joined), whichever is larger
+    """
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+class Stages():
+    """ Accumulated time of the named stages
+    """
+
+    def __init__(self):
+        self.seconds = {}
+
+    def run(self, name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - started
+        return result
+
+    def report(self, count):
+        return {name: {'seconds': seconds, 'ms_per_image': 1000 * seconds / count} for name, seconds in self.seconds.items()}
+
+
+def batches(ids, batch_size):
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size]
+
+
+def open_bench_covers(folder):
+    from cover_store import CoverStore, Base64Folder
+    return CoverStore(os.path.join(folder, 'covers')), Base64Folder(os.path.join(folder, 'files'))
+
+
+def bench_scoring(folder, batch_size, threads):
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    import cover_model
+    from cover_images import CoverLoader
+    from score_store import JsonLinesScoreStore
+
+    # the architecture of vgg_train.py, pretrained VGG16 weights only when keras has them downloaded
+    cached = os.path.isfile(os.path.join(os.path.expanduser('~'), '.keras', 'models', 'vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'))
+    model = tf.keras.Sequential([
+        tf.keras.layers.InputLayer(input_shape=cover_model.IMAGE_SHAPE),
+        tf.keras.applications.VGG16(input_shape=cover_model.IMAGE_SHAPE, include_top=False, weights='imagenet' if cached else None),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(64, activation='relu'),
+        tf.keras.layers.Dense(1, activation='sigmoid'),
+    ])
+
+    covers, base64_covers = open_bench_covers(folder)
+    ids = sorted(covers.ids(), key=int)
+    model.predict_on_batch(np.zeros((batch_size, *cover_model.IMAGE_SHAPE), dtype=np.float32))
+
+    store_file = os.path.join(folder, 'bench-scores.jsonl')
+    if os.path.isfile(store_file):
+        os.remove(store_file)
+
+    stages = Stages()
+    store = JsonLinesScoreStore(store_file)
+    # the decoding includes the resize, a JPEG is decoded close to the target size
+    loader = CoverLoader(cover_model.IMAGE_SIZE, threads=threads)
+    for chunk in batches(ids, batch_size):
+        stages.run('read_base64', base64_covers.read_many, chunk)
+        contents = stages.run('read', covers.read_many, chunk)
+        images, _ = stages.run('decode', loader.load_batch, contents)
+        prediction = stages.run('forward', model.predict_on_batch, images.astype(np.float32))
+        for id, value in zip(chunk, prediction[:, 0]):
+            store.add(int(id), float(value))
+        stages.run('store', store.flush)
+    stages.run('export_json', store.export_json, os.path.join(folder, 'bench-scores.json'))
+    store.close()
+    loader.close()
+
+    # the input pipeline of vgg_run.py, with the stages overlapping
+    started = time.perf_counter()
+    for _, images in cover_model.iter_batches(covers, ids, batch_size, threads=threads):
+        model.predict_on_batch(images.astype(np.float32))
+    elapsed = time.perf_counter() - started
+
+    return {'pretrained': cached, 'stages': stages.report(len(ids)), 'images_per_sec': len(ids) / elapsed}
+
+
+def bench_embedding(folder, batch_size, threads, model_name='resnet18'):
+    import torch
+    import torchvision.models as models
+    torch.set_num_threads(threads)
+    from img2vec import Img2Vec, batch_tensor
+    from cover_images import CoverLoader
+    from cover_cache import CoverCache
+    import embedding_store
+    import embed
+
+    url = models.get_model_weights(model_name).DEFAULT.url
+    cached = os.path.isfile(os.path.join(torch.hub.get_dir(), 'checkpoints', os.path.basename(url)))
+    img2vec = Img2Vec(model=model_name, pretrained=cached)
+    loader = CoverLoader(threads=threads)
+
+    covers, _ = open_bench_covers(folder)
+    ids = sorted(covers.ids(), key=int)
+    img2vec.get_vec(torch.zeros(batch_size, 3, 224, 224))
+
+    stages = Stages()
+    vectors = []
+    for chunk in batches(ids, batch_size):
+        contents = stages.run('read', covers.read_many, chunk)
+        images, _ = stages.run('decode', loader.load_batch, contents)
+        tensors = stages.run('transform', batch_tensor, images)
+        vectors.extend(stages.run('forward', img2vec.get_vec, tensors))
+    loader.close()
+    result_name = os.path.join(folder, 'bench-embeddings')
+    stages.run('write', embedding_store.write, result_name, zip(ids, vectors), len(ids), img2vec.layer_output_size, np.float16, {'model': model_name})
+
+    # embed.py with an empty cache, decoding with a thread per benchmark thread
+    cache_file = os.path.join(folder, 'bench-cache.sqlite')
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+    with CoverCache(cache_file) as cache:
+        hashes = covers.hashes(ids)
+        started = time.perf_counter()
+        embed.embed_missing(img2vec, covers, ids, hashes, cache, batch_size, threads)
+        elapsed = time.perf_counter() - started
+
+    return {'pretrained': cached, 'stages': stages.report(len(ids)), 'images_per_sec': len(ids) / elapsed}
+
+
+def bench_bovw(folder, batch_size, threads, algorithm='sift'):
+    import cv2
+    from multiprocessing import Pool
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outdated'))
+    import bovw
+    import cover_images
+    from kmeans import CentroidIndex
+
+    cv2.setNumThreads(threads)
+    covers, _ = open_bench_covers(folder)
+    ids = sorted(covers.ids(), key=int)
+    codebook = np.random.RandomState(42).rand(CODEBOOK_SIZE, 128).astype(np.float32) * 100
+    extractor = cv2.SIFT_create() if algorithm == 'sift' else cv2.ORB_create()
+    index = CentroidIndex(codebook)
+
+    stages = Stages()
+    for chunk in batches(ids, batch_size):
+        contents = stages.run('read', covers.read_many, chunk)
+        # decoded straight into grayscale
+        images = stages.run('decode', lambda: [cover_images.load(x, None, 'L') for x in contents])
+        descriptors = stages.run('detect', lambda: [extractor.detectAndCompute(x, None)[1] for x in images])
+        stages.run('assign', lambda: [index.assign(x.astype(np.float32)) for x in descriptors if x is not None])
+
+    # bovw.py word counts with a pool of processes, one per thread
+    started = time.perf_counter()
+    with Pool(threads, initializer=bovw.init_worker, initargs=(algorithm, covers, codebook)) as pool:
+        bovw.calculate_word_freq(pool, ids)
+        # the workers are waited for, so their peak memory is reported by peak_rss_mb
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - started
+
+    return {'stages': stages.report(len(ids)), 'images_per_sec': len(ids) / elapsed}
+
+
+BENCHMARKS = {
+    'scoring': bench_scoring,
+    'embedding': bench_embedding,
+    'bovw': bench_bovw,
+}
+
+
+def run_child(folder, task, batch_size, threads):
+    started = time.perf_counter()
+    result = BENCHMARKS[task](folder, batch_size, threads)
+    return {
+        'task': task,
+        'batch_size': batch_size,
+        'threads': threads,
+        **result,
+        'total_seconds': time.perf_counter() - started,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Benchmark')
+    parser.add_argument('--folder', default=BENCH_FOLDER, help='synthetic covers are generated here')
+    parser.add_argument('--count', type=int, default=COUNT)
+    parser.add_argument('--tasks', default=','.join(TASKS))
+    parser.add_argument('--batch_sizes', type=parse_list, default=BATCH_SIZES)
+    parser.add_argument('--threads', type=parse_list, default=THREADS)
+    parser.add_argument('--output', default=RESULT_FILE)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # one configuration, the result is the last line of the output
+        result = run_child(args.folder, args.child, args.batch_sizes[0], args.threads[0])
+        print(json.dumps(result))
+        return 0
+
+    generate(args.folder, args.count)
+    results = []
+    for task in args.tasks.split(','):
+        for batch_size in args.batch_sizes:
+            for threads in args.threads:
+                print('running', task, 'batch size', batch_size, 'threads', threads)
+                process = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--child', task, '--folder', args.folder,
+                     '--batch_sizes', str(batch_size), '--threads', str(threads)],
+                    stdout=subprocess.PIPE, text=True)
+                if process.returncode != 0:
+                    print('failed', task, batch_size, threads)
+                    continue
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+                print(f"{result['images_per_sec']:.1f} images/sec, peak {result['peak_rss_mb']} MB")
+                results.append(result)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'count': args.count,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('saved', args.output)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
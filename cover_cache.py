@@ -0,0 +1,128 @@
+import os
+import base64
+import sqlite3
+import hashlib
+import numpy as np
+
+CACHE_FILE = 'cover-cache.sqlite'
+QUERY_CHUNK_SIZE = 500
+
+
+def content_hash(contents):
+    """ Hash of the image bytes behind a base64 encoded cover file
+    """
+    return hashlib.sha1(base64.b64decode(contents)).hexdigest()
+
+
+def model_fingerprint(path):
+    """ Fingerprint of a saved model file or folder, changes whenever the model is retrained
+    """
+    digest = hashlib.sha1()
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+    for file in files:
+        digest.update(os.path.relpath(file, path).encode())
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+
+    return digest.hexdigest()[:16]
+
+
+class CoverCache():
+    """ Model outputs keyed by (cover content hash, model fingerprint, preprocessing version)
+
+    The content hash of every cover file is remembered together with its size and mtime,
+    so only new or modified files are read and hashed again.
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries (hash TEXT, model TEXT, preprocessing INTEGER, value BLOB, PRIMARY KEY (hash, model, preprocessing))')
+        self.connection.commit()
+
+    def hash_files(self, paths):
+        known = {path: (size, mtime, hash) for path, size, mtime, hash in self.connection.execute('SELECT path, size, mtime, hash FROM files')}
+
+        result = {}
+        changed = []
+        for path in paths:
+            key = os.path.realpath(path)
+            stat = os.stat(key)
+            entry = known.get(key)
+            if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                result[path] = entry[2]
+                continue
+
+            with open(key, 'rb') as f:
+                hash = content_hash(f.read())
+            result[path] = hash
+            changed.append((key, stat.st_size, stat.st_mtime_ns, hash))
+
+        if changed:
+            print('hashed covers', len(changed))
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO files (path, size, mtime, hash) VALUES (?, ?, ?, ?)', changed)
+
+        return result
+
+    def get_many(self, hashes, model, preprocessing):
+        hashes = list(hashes)
+        result = {}
+        for i in range(0, len(hashes), QUERY_CHUNK_SIZE):
+            chunk = hashes[i:i + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                f"SELECT hash, value FROM entries WHERE model = ? AND preprocessing = ? AND hash IN ({','.join('?' * len(chunk))})",
+                [model, preprocessing, *chunk])
+            for hash, value in rows:
+                result[hash] = np.frombuffer(value, dtype=np.float32)
+        return result
+
+    def missing(self, hashes, model, preprocessing):
+        """ The hashes without a cached value, without loading the values themselves
+        """
+        missing = set(hashes)
+        hashes = list(missing)
+        for i in range(0, len(hashes), QUERY_CHUNK_SIZE):
+            chunk = hashes[i:i + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                f"SELECT hash FROM entries WHERE model = ? AND preprocessing = ? AND hash IN ({','.join('?' * len(chunk))})",
+                [model, preprocessing, *chunk])
+            missing.difference_update(hash for hash, in rows)
+        return missing
+
+    def failed(self, hashes, model, preprocessing):
+        """ The hashes cached as a single NaN (cover_model.FAILED), the covers that failed to decode
+        """
+        hashes = list(hashes)
+        failed = set()
+        for i in range(0, len(hashes), QUERY_CHUNK_SIZE):
+            chunk = hashes[i:i + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                f"SELECT hash, value FROM entries WHERE model = ? AND preprocessing = ? AND length(value) = 4 AND hash IN ({','.join('?' * len(chunk))})",
+                [model, preprocessing, *chunk])
+            failed.update(hash for hash, value in rows if np.isnan(np.frombuffer(value, dtype=np.float32)[0]))
+        return failed
+
+    def put_many(self, entries, model, preprocessing):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO entries (hash, model, preprocessing, value) VALUES (?, ?, ?, ?)',
+            [(hash, model, preprocessing, np.asarray(value, dtype=np.float32).tobytes()) for hash, value in entries])
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
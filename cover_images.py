@@ -0,0 +1,102 @@
+# Cover decoding shared by the Python scripts. JPEG covers are decoded in draft mode: libjpeg scales the DCT by
+# 1/2, 1/4 or 1/8 while decoding, so a big cover is decoded close to the target size instead of at its full
+# resolution before the resize. Batches are decoded by a pool of threads (PIL releases the GIL while decoding
+# and resizing) straight into preallocated contiguous uint8 arrays, without a tensor per cover
+
+import numpy as np
+import os
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import metrics
+
+# (height, width) like the tensors, PIL sizes are (width, height)
+IMAGE_SIZE = (224, 224)
+THREADS = os.cpu_count() or 1
+RESAMPLE = Image.BILINEAR
+CHANNELS = {'RGB': 3, 'L': 1}
+
+
+def decode(content, size=None, mode='RGB'):
+    """ PIL image of the cover in the mode, a JPEG is decoded at the smallest DCT scale that still gives at
+    least size (height, width), at its full resolution without a size
+    """
+    image = Image.open(BytesIO(content))
+    image.draft(mode, None if size is None else (size[1], size[0]))
+    return image if image.mode == mode else image.convert(mode)
+
+
+def load(content, size=IMAGE_SIZE, mode='RGB', out=None):
+    """ uint8 array of the cover resized to size, (height, width, 3) in RGB and (height, width) in L, written
+    into out when it is given. Without a size the cover keeps its resolution
+    """
+    image = decode(content, size, mode)
+    if size is not None and image.size != (size[1], size[0]):
+        image = image.resize((size[1], size[0]), RESAMPLE)
+    if out is None:
+        return np.asarray(image)
+    out[...] = np.asarray(image)
+    return out
+
+
+class CoverLoader():
+    """ Decodes batches of covers of the same size with a pool of threads into uint8 arrays of shape
+    (batch, height, width, 3), or (batch, height, width) in mode L
+    """
+
+    def __init__(self, size=IMAGE_SIZE, mode='RGB', threads=None):
+        self.size = tuple(size)
+        self.mode = mode
+        self.shape = (*self.size, CHANNELS[mode]) if CHANNELS[mode] > 1 else self.size
+        self.pool = ThreadPoolExecutor(threads or THREADS)
+
+    def load_batch(self, contents, out=None):
+        """ (images, ok) of the cover contents, ok is False for the covers that failed to decode, which are black
+        """
+        if out is None:
+            out = np.empty((len(contents), *self.shape), dtype=np.uint8)
+        out = out[:len(contents)]
+        ok = np.ones(len(contents), dtype=bool)
+
+        def work(i):
+            try:
+                load(contents[i], self.size, self.mode, out[i])
+            except Exception as ex:
+                # PIL raises many kinds of errors for broken files
+                print('failed to decode cover', ex)
+                ok[i] = False
+                out[i] = 0
+
+        with metrics.timer('decode', len(contents)):
+            list(self.pool.map(work, range(len(contents))))
+        return out, ok
+
+    def batches(self, covers, ids, batch_size):
+        """ Yields (ids, images, ok) of the covers in batches, the next batch is read and decoded while the current
+        one is used. The images are written into two reused arrays, so a batch is only valid until the next one
+        """
+        buffers = [np.empty((batch_size, *self.shape), dtype=np.uint8) for _ in range(2)]
+        chunks = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+        def read(chunk, buffer):
+            with metrics.timer('read', len(chunk)):
+                contents = covers.read_many(chunk)
+            return (chunk, *self.load_batch(contents, buffer))
+
+        # a single reader thread, the covers are read by one thread at a time
+        with ThreadPoolExecutor(1) as reader:
+            future = reader.submit(read, chunks[0], buffers[0]) if chunks else None
+            for i in range(len(chunks)):
+                result = future.result()
+                if i + 1 < len(chunks):
+                    future = reader.submit(read, chunks[i + 1], buffers[(i + 1) % 2])
+                yield result
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
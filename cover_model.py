@@ -0,0 +1,111 @@
+# The cover scoring model and its input pipeline, shared by vgg_run.py and quantize.py. The model is the saved
+# Keras model, its traced serving signature or a TFLite conversion of it, all score batches of covers decoded by
+# cover_images.py. TensorFlow is imported on first use, so vgg_run.py finds out whether anything is left to
+# score without it
+
+import numpy as np
+import os
+from cover_cache import model_fingerprint
+from cover_images import CoverLoader
+
+MODEL_FOLDER = os.path.join('.', 'trained_binary_vgg')
+IMAGE_SIZE = (224, 224)
+CHANNELS = 3
+IMAGE_SHAPE = (*IMAGE_SIZE, CHANNELS)
+BATCH_SIZE = 32
+# Bump whenever the decoding of the covers changes, so the cached scores are recalculated
+PREPROCESSING_VERSION = 2
+SIGNATURE = 'serving_default'
+# Cached instead of a score for the covers that failed to decode, so they are not tried again on every run
+FAILED = np.array([np.nan], dtype=np.float32)
+
+
+def iter_batches(covers, ids, batch_size=BATCH_SIZE, image_size=IMAGE_SIZE, threads=None, failed=None):
+    """ Yields (ids, images) with the covers as a (N, height, width, 3) uint8 array, without the covers that failed
+    to decode (their ids are appended to the failed list when it is given). The next batch is decoded while the
+    model works on the current one, and the arrays are reused, so a batch is only valid until the next one
+    """
+    with CoverLoader(image_size, threads=threads) as loader:
+        for chunk, batch, ok in loader.batches(covers, ids, batch_size):
+            if not ok.all():
+                broken = [x for x, good in zip(chunk, ok) if not good]
+                print('failed to decode', broken)
+                if failed is not None:
+                    failed.extend(broken)
+                chunk = [x for x, good in zip(chunk, ok) if good]
+                batch = batch[ok]
+            if chunk:
+                yield chunk, batch
+
+
+class KerasScorer():
+    def __init__(self, path=MODEL_FOLDER):
+        import tensorflow as tf
+        self.model = tf.keras.models.load_model(path)
+        self.image_size = tuple(self.model.input_shape[1:3])
+        self.fingerprint = model_fingerprint(path)
+
+    def predict(self, images):
+        """ Scores of a batch of decoded covers, shape (N, 1)
+        """
+        return np.asarray(self.model.predict_on_batch(np.asarray(images, dtype=np.float32)))
+
+
+class SignatureScorer():
+    """ The traced serving function of the saved model, loaded without rebuilding the Keras model around it. It
+    runs once on a batch of zeros when loaded, so the first covers do not wait for the warmup
+    """
+
+    def __init__(self, path=MODEL_FOLDER, signature=SIGNATURE):
+        import tensorflow as tf
+        # the function only holds weak references to the variables of the loaded object
+        self.loaded = tf.saved_model.load(path)
+        self.function = self.loaded.signatures[signature]
+        (self.input_name, spec), = self.function.structured_input_signature[1].items()
+        self.output_name = sorted(self.function.structured_outputs)[0]
+        self.image_size = tuple(spec.shape[1:3])
+        self.fingerprint = model_fingerprint(path)
+        self.predict(np.zeros((BATCH_SIZE, *self.image_size, CHANNELS), dtype=np.float32))
+
+    def predict(self, images):
+        import tensorflow as tf
+        return self.function(**{self.input_name: tf.cast(images, tf.float32)})[self.output_name].numpy()
+
+
+class TFLiteScorer():
+    """ Quantized model converted by quantize.py, the input tensor is resized to the batch size
+    """
+
+    def __init__(self, path, threads=None):
+        import tensorflow as tf
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.image_size = tuple(int(x) for x in self.input['shape'][1:3])
+        self.batch_size = None
+        self.fingerprint = model_fingerprint(path)
+
+    def predict(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        if len(images) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input['index'], images.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(images)
+        self.interpreter.set_tensor(self.input['index'], images)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output['index']).copy()
+
+
+def load_scorer(path=MODEL_FOLDER, threads=None, signature=None):
+    """ threads limits the TensorFlow thread pools and the TFLite interpreter,
+    signature loads that serving signature of a saved model instead of the Keras model
+    """
+    import tensorflow as tf
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    if path.endswith('.tflite'):
+        return TFLiteScorer(path, threads)
+    if signature:
+        return SignatureScorer(path, signature)
+    return KerasScorer(path)
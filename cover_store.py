@@ -0,0 +1,250 @@
+# Covers as raw image bytes in a few large pack files with an offset index, so the Python scripts
+# read them without the base64 overhead of the files written by the scraper. The scraper keeps
+# writing `files`, running this script (or opening the store) adds the new covers to the packs
+
+import os
+import sys
+import fcntl
+import base64
+import binascii
+import sqlite3
+import hashlib
+import argparse
+from tqdm import tqdm
+import shared
+
+COVERS_FOLDER = os.path.join('.', 'covers')
+FILES_FOLDER = shared.FILES_FOLDER
+INDEX_FILE = 'index.sqlite'
+LOCK_FILE = 'pack.lock'
+PACK_SIZE = 1 << 30
+COMMIT_EVERY = 1000
+
+
+def index_file(folder):
+    return os.path.join(folder, INDEX_FILE)
+
+
+def lock_file(folder):
+    return os.path.join(folder, LOCK_FILE)
+
+
+def pack_file(folder, pack):
+    return os.path.join(folder, f'pack-{pack:05d}.bin')
+
+
+def _connect(folder):
+    connection = sqlite3.connect(index_file(folder), timeout=60)
+    connection.execute('CREATE TABLE IF NOT EXISTS covers (id TEXT PRIMARY KEY, pack INTEGER, offset INTEGER, length INTEGER, hash TEXT, source_size INTEGER, source_mtime INTEGER)')
+    return connection
+
+
+def migrate(files_folder=FILES_FOLDER, folder=COVERS_FOLDER, pack_size=PACK_SIZE):
+    """ Appends the base64 covers of files_folder that are new or changed (by the size and mtime of the file)
+    to the packs, returns the number of added covers. Replaced covers leave their old bytes in the packs
+    """
+    os.makedirs(folder, exist_ok=True)
+    # one process packs at a time, the others wait for it and then find its covers in the index
+    with open(lock_file(folder), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _migrate(files_folder, folder, pack_size)
+
+
+def _migrate(files_folder, folder, pack_size):
+    connection = _connect(folder)
+    known = {id: (size, mtime) for id, size, mtime in connection.execute('SELECT id, source_size, source_mtime FROM covers')}
+
+    with os.scandir(files_folder) as entries:
+        pending = [(x.name, x.stat()) for x in entries if x.is_file()]
+    pending = [(name, stat) for name, stat in pending if known.get(name) != (stat.st_size, stat.st_mtime_ns)]
+    if not pending:
+        connection.close()
+        return 0
+    # numeric ids in their natural order, so the covers of the neighbouring books are close in the pack
+    pending.sort(key=lambda x: (len(x[0]), x[0]))
+
+    pack = connection.execute('SELECT COALESCE(MAX(pack), 0) FROM covers').fetchone()[0]
+    f = open(pack_file(folder, pack), 'ab')
+    offset = f.seek(0, os.SEEK_END)
+    rows = []
+
+    def commit():
+        # the bytes are on disk before the index points to them, a crash only leaves unused bytes
+        f.flush()
+        os.fsync(f.fileno())
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO covers (id, pack, offset, length, hash, source_size, source_mtime) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        rows.clear()
+
+    added = 0
+    for name, stat in tqdm(pending, desc='packing covers'):
+        with open(os.path.join(files_folder, name), 'rb') as source:
+            try:
+                data = base64.b64decode(source.read())
+            except binascii.Error as ex:
+                print('failed to decode', name, ex)
+                continue
+
+        if offset > 0 and offset + len(data) > pack_size:
+            commit()
+            f.close()
+            pack += 1
+            f = open(pack_file(folder, pack), 'ab')
+            offset = f.seek(0, os.SEEK_END)
+
+        f.write(data)
+        rows.append((name, pack, offset, len(data), hashlib.sha1(data).hexdigest(), stat.st_size, stat.st_mtime_ns))
+        offset += len(data)
+        added += 1
+        if len(rows) >= COMMIT_EVERY:
+            commit()
+
+    commit()
+    f.close()
+    connection.close()
+    return added
+
+
+class CoverStore():
+    """ Reader of the packed covers: read(id) returns the image bytes, read_many(ids) reads them in the pack order
+    """
+
+    def __init__(self, folder=COVERS_FOLDER):
+        self.folder = folder
+        connection = _connect(folder)
+        self.index = {id: (pack, offset, length, hash) for id, pack, offset, length, hash in connection.execute('SELECT id, pack, offset, length, hash FROM covers')}
+        connection.close()
+        self.packs = {}
+        self.pid = os.getpid()
+
+    def __contains__(self, id):
+        return str(id) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def ids(self):
+        return list(self.index.keys())
+
+    def _pack(self, pack):
+        if self.pid != os.getpid():
+            # forked worker processes share the file positions of the inherited files, so they open their own
+            self.packs = {}
+            self.pid = os.getpid()
+        f = self.packs.get(pack)
+        if f is None:
+            f = self.packs[pack] = open(pack_file(self.folder, pack), 'rb')
+        return f
+
+    def read(self, id):
+        pack, offset, length, _ = self.index[str(id)]
+        f = self._pack(pack)
+        f.seek(offset)
+        return f.read(length)
+
+    def read_many(self, ids):
+        """ Image bytes of the ids in the same order, read sequentially through the packs
+        """
+        ids = [str(x) for x in ids]
+        result = [None] * len(ids)
+        for i in sorted(range(len(ids)), key=lambda i: self.index[ids[i]][:2]):
+            result[i] = self.read(ids[i])
+        return result
+
+    def hashes(self, ids, cache=None):
+        """ Dict id -> content hash, the same as cover_cache.content_hash of the base64 file
+        """
+        return {x: self.index[str(x)][3] for x in ids}
+
+    def close(self):
+        for f in self.packs.values():
+            f.close()
+        self.packs = {}
+
+    def __getstate__(self):
+        # the open packs stay in the process that opened them, worker processes open their own
+        return {**self.__dict__, 'packs': {}}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Base64Folder():
+    """ The same reader API over the base64 files of the scraper, used while the covers are not packed
+    """
+
+    def __init__(self, folder=FILES_FOLDER):
+        self.folder = folder
+        self.names = shared.list_files(folder)
+
+    def __contains__(self, id):
+        return str(id) in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def ids(self):
+        return list(self.names)
+
+    def path(self, id):
+        return os.path.join(self.folder, str(id))
+
+    def read(self, id):
+        with open(self.path(id), 'rb') as f:
+            return base64.b64decode(f.read())
+
+    def read_many(self, ids):
+        return [self.read(x) for x in ids]
+
+    def hashes(self, ids, cache=None):
+        """ Dict id -> content hash, remembered by the cover cache by the file size and mtime when it is given
+        """
+        ids = list(ids)
+        if cache is not None:
+            hashes = cache.hash_files([self.path(x) for x in ids])
+            return {x: hashes[self.path(x)] for x in ids}
+        return {x: hashlib.sha1(self.read(x)).hexdigest() for x in ids}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_covers(folder=COVERS_FOLDER, files_folder=FILES_FOLDER, pack=True):
+    """ The packed covers with the newly scraped or replaced files added (unless pack is False, for processes
+    that only read what another one packed), or the base64 files when they were never packed
+    """
+    if not os.path.isfile(index_file(folder)):
+        print('no packed covers in', folder, 'reading', files_folder)
+        return Base64Folder(files_folder)
+
+    if pack and os.path.isdir(files_folder):
+        added = migrate(files_folder, folder)
+        if added:
+            print('packed new covers', added)
+    return CoverStore(folder)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Cover store')
+    parser.add_argument('--files', default=FILES_FOLDER, help='base64 covers written by the scraper')
+    parser.add_argument('--folder', default=COVERS_FOLDER)
+    parser.add_argument('--pack_size', type=int, default=PACK_SIZE)
+    args = parser.parse_args()
+
+    added = migrate(args.files, args.folder, args.pack_size)
+    with CoverStore(args.folder) as store:
+        print('packed', added, 'covers, total', len(store))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
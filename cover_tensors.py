@@ -0,0 +1,115 @@
+# Decodes the labeled covers once into memory-mapped arrays, so the training scripts do not
+# re-decode and re-resize the JPEGs in `images` on every epoch of every run. The covers are decoded
+# by cover_images.py, like vgg_run.py decodes them for the scoring
+
+import tensorflow as tf
+import numpy as np
+import os
+import sys
+import argparse
+from tqdm import tqdm
+from cover_store import open_covers, COVERS_FOLDER
+from cover_images import CoverLoader
+import shared
+
+FILES_FOLDER = os.path.join('.', 'files')
+TENSORS_FOLDER = os.path.join('.', 'tensors')
+IMAGE_SIZE = (224, 224)
+CHANNELS = 3
+IMAGE_SHAPE = (*IMAGE_SIZE, CHANNELS)
+COPY_CHUNK_SIZE = 1024
+DECODE_BATCH_SIZE = 256
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def prepare(folder=TENSORS_FOLDER, covers_folder=COVERS_FOLDER):
+    db = shared.load_columns(shared.DB_FILE, ['id', 'label'])
+    books = [{'id': id, 'label': label} for id, label in zip(db['id'], db['label']) if label is not None]
+    covers = open_covers(covers_folder, FILES_FOLDER)
+    books = [x for x in books if x['id'] in covers]
+    books.sort(key=lambda x: x['id'])
+    print('labeled entries with image', len(books))
+
+    labels_by_id = {x['id']: 1.0 if x['label'] else 0.0 for x in books}
+
+    os.makedirs(folder, exist_ok=True)
+    images_file = os.path.join(folder, 'images.npy')
+    images = np.lib.format.open_memmap(images_file + '.tmp', mode='w+', dtype=np.uint8, shape=(len(books), *IMAGE_SHAPE))
+    ids = []
+    labels = []
+    with CoverLoader(IMAGE_SIZE) as loader:
+        batches = loader.batches(covers, [x['id'] for x in books], DECODE_BATCH_SIZE)
+        for chunk, batch, ok in tqdm(batches, total=(len(books) + DECODE_BATCH_SIZE - 1) // DECODE_BATCH_SIZE):
+            chunk = [x for x, good in zip(chunk, ok) if good]
+            images[len(ids):len(ids) + len(chunk)] = batch[ok]
+            ids.extend(chunk)
+            labels.extend(labels_by_id[x] for x in chunk)
+
+    if len(ids) < len(books):
+        print('failed to decode', len(books) - len(ids))
+        trimmed = np.lib.format.open_memmap(images_file + '.trim', mode='w+', dtype=np.uint8, shape=(len(ids), *IMAGE_SHAPE))
+        for start in range(0, len(ids), COPY_CHUNK_SIZE):
+            end = min(start + COPY_CHUNK_SIZE, len(ids))
+            trimmed[start:end] = images[start:end]
+        trimmed.flush()
+        del images
+        os.replace(images_file + '.trim', images_file + '.tmp')
+    else:
+        images.flush()
+        del images
+
+    np.save(os.path.join(folder, 'ids.npy'), np.array(ids, dtype=np.int64))
+    np.save(os.path.join(folder, 'labels.npy'), np.array(labels, dtype=np.float32))
+    os.replace(images_file + '.tmp', images_file)
+    covers.close()
+    print('images', (len(ids), *IMAGE_SHAPE), 'positive', int(np.sum(labels)))
+
+
+def make_dataset(images, labels, indexes, batch_size, shuffle, seed=42):
+    """ Batches of (float32 images, binary labels) read from memory-mapped arrays of any shape and dtype
+    """
+    def read(batch):
+        # Sorted reads keep the memory-mapped file access mostly sequential
+        batch = np.sort(batch)
+        return images[batch], labels[batch].reshape(-1, 1).astype(np.float32)
+
+    def set_shapes(x, y):
+        x.set_shape((None, *images.shape[1:]))
+        y.set_shape((None, 1))
+        return tf.cast(x, tf.float32), y
+
+    ds = tf.data.Dataset.from_tensor_slices(indexes)
+    if shuffle:
+        ds = ds.shuffle(len(indexes), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(lambda batch: tf.numpy_function(read, [batch], [tf.as_dtype(images.dtype), tf.float32]), num_parallel_calls=AUTOTUNE)
+    return ds.map(set_shapes)
+
+
+def load_datasets(folder=TENSORS_FOLDER, validation_split=0.2, seed=42, batch_size=32):
+    """ Training and validation datasets streaming from the prepared arrays, with the same
+    format as image_dataset_from_directory(label_mode='binary')
+    """
+    images = np.load(os.path.join(folder, 'images.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(folder, 'labels.npy'))
+    print('loaded', images.shape, 'from', folder)
+
+    indexes = np.random.RandomState(seed).permutation(len(labels))
+    split = int(len(indexes) * (1 - validation_split))
+    train_ds = make_dataset(images, labels, indexes[:split], batch_size, shuffle=True, seed=seed)
+    val_ds = make_dataset(images, labels, indexes[split:], batch_size, shuffle=False)
+    return train_ds, val_ds
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Cover tensors')
+    parser.add_argument('--folder', default=TENSORS_FOLDER)
+    parser.add_argument('--covers', default=COVERS_FOLDER)
+    args = parser.parse_args()
+
+    prepare(args.folder, args.covers)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# Distills the saved cover model (the teacher, trained_binary_vgg or trained_binary_efficientnet) into a small
+# MobileNetV3 student scoring 128x128 covers. The student learns the teacher scores of every packed cover, not
+# only of the labeled ones, the teacher scores are taken from the cover cache when vgg_run.py already has them.
+# The student is saved as a Keras model like the teacher, for vgg_run.py --model or --cascade_model
+
+import tensorflow as tf
+import numpy as np
+import os
+import sys
+import json
+import argparse
+from scipy.stats import rankdata
+from tqdm import tqdm
+from cover_store import open_covers, COVERS_FOLDER, FILES_FOLDER
+from cover_cache import CoverCache, CACHE_FILE
+import cover_model
+from cover_model import iter_batches
+from quantize import compare, score
+import shared
+import metrics
+import training
+
+STUDENT_FOLDER = os.path.join('.', 'trained_cover_student')
+STUDENT_IMAGE_SIZE = (128, 128)
+BATCH_SIZE = 64
+NUM_EPOCHS = 5
+LEARNING_RATE = 1e-3
+FLUSH_EVERY = 10
+# Share of the labeled covers kept out of the distillation, to compare the AUC of the teacher and the student
+HOLDOUT_SHARE = 0.2
+SPEED_SAMPLES = 256
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def auc(labels, scores):
+    """ Area under the ROC curve: the probability that a liked cover scores higher than a disliked one
+    """
+    labels = np.asarray(labels, dtype=bool)
+    positives = int(labels.sum())
+    negatives = len(labels) - positives
+    if not positives or not negatives:
+        return None
+    ranks = rankdata(scores)
+    return float((ranks[labels].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
+
+def teacher_scores(teacher, covers, ids, hashes, cache):
+    """ Dict id -> teacher score, the covers without a cached score are scored and cached. The covers that failed
+    to decode (cached as FAILED, like vgg_run.py does) have no score
+    """
+    cached = cache.get_many(set(hashes.values()), teacher.fingerprint, cover_model.PREPROCESSING_VERSION)
+    scores = {x: float(cached[hashes[x]][0]) for x in ids if hashes[x] in cached and not np.isnan(cached[hashes[x]][0])}
+    pending = [x for x in ids if hashes[x] not in cached]
+    print('teacher scores cached', len(scores), 'to score', len(pending))
+
+    failed = []
+    batches = iter_batches(covers, pending, image_size=teacher.image_size, failed=failed)
+    for batch, (chunk, images) in enumerate(tqdm(batches, total=(len(pending) + cover_model.BATCH_SIZE - 1) // cover_model.BATCH_SIZE)):
+        with metrics.timer('teacher', len(chunk)):
+            prediction = teacher.predict(images)
+        cache.put_many([(hashes[id], prediction[idx]) for idx, id in enumerate(chunk)], teacher.fingerprint, cover_model.PREPROCESSING_VERSION)
+        scores.update((id, float(prediction[idx][0])) for idx, id in enumerate(chunk))
+        if (batch + 1) % FLUSH_EVERY == 0:
+            cache.commit()
+    cache.put_many([(hashes[id], cover_model.FAILED) for id in failed], teacher.fingerprint, cover_model.PREPROCESSING_VERSION)
+    cache.commit()
+    return scores
+
+
+def make_student(image_size=STUDENT_IMAGE_SIZE, alpha=1.0, weights='imagenet'):
+    """ MobileNetV3Small with a head like the teacher's, it takes the same 0-255 covers (the rescaling is a
+    layer of the backbone)
+    """
+    shape = (*image_size, cover_model.CHANNELS)
+    backbone = tf.keras.applications.MobileNetV3Small(input_shape=shape, alpha=alpha, include_top=False,
+                                                      weights=weights, pooling='avg')
+    return tf.keras.Sequential([
+        tf.keras.layers.InputLayer(input_shape=shape),
+        backbone,
+        tf.keras.layers.Dense(64, activation='relu'),
+        tf.keras.layers.Dense(1, activation='sigmoid', dtype='float32'),  # float32 with mixed precision
+    ])
+
+
+def make_dataset(covers, ids, targets, image_size, batch_size, shuffle, seed=42):
+    """ Batches of (covers, teacher scores), in a new random order on every epoch when shuffle is set
+    """
+    random = np.random.RandomState(seed)
+
+    def generate():
+        order = [ids[i] for i in random.permutation(len(ids))] if shuffle else ids
+        for chunk, images in iter_batches(covers, order, batch_size, image_size):
+            # the batches of iter_batches are reused, they are copied for tf.data
+            yield images.copy(), np.array([[targets[x]] for x in chunk], dtype=np.float32)
+
+    ds = tf.data.Dataset.from_generator(generate, output_signature=(
+        tf.TensorSpec(shape=(None, *image_size, cover_model.CHANNELS), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None, 1), dtype=tf.float32)))
+    return ds.map(lambda x, y: (tf.cast(x, tf.float32), y)).prefetch(AUTOTUNE)
+
+
+def predict(scorer, covers, ids):
+    """ Dict id -> score, without the covers that failed to decode
+    """
+    scores = {}
+    for chunk, images in iter_batches(covers, ids, image_size=scorer.image_size):
+        scores.update(zip(chunk, scorer.predict(images)[:, 0].tolist()))
+    return scores
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Distill')
+    parser.add_argument('--teacher', default=cover_model.MODEL_FOLDER, help='saved model folder (or .tflite) of the teacher')
+    parser.add_argument('--output', default=STUDENT_FOLDER)
+    parser.add_argument('--image_size', type=int, default=STUDENT_IMAGE_SIZE[0])
+    parser.add_argument('--alpha', type=float, default=1.0, choices=[0.75, 1.0], help='width of the MobileNetV3Small student')
+    parser.add_argument('--epochs', type=int, default=NUM_EPOCHS)
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--limit', type=int, help='distill on a random sample of this many covers')
+    parser.add_argument('--fast', action='store_true', help='XLA and mixed precision where supported')
+    parser.add_argument('--covers', default=COVERS_FOLDER)
+    parser.add_argument('--files', default=FILES_FOLDER)
+    parser.add_argument('--cache', default=CACHE_FILE)
+    parser.add_argument('--data', default=shared.DB_FILE)
+    args = parser.parse_args()
+
+    metrics.start_profile('distill')
+    mode = 'fast' if args.fast else 'baseline'
+    if args.fast:
+        training.enable_mixed_precision()
+
+    covers = open_covers(args.covers, args.files)
+    books = shared.load_columns(args.data, ['id', 'label'])
+    labels = {str(id): bool(label) for id, label in zip(books['id'], books['label']) if label is not None and str(id) in covers}
+
+    # the held out labeled covers are only used for the report, the student never sees them
+    random = np.random.RandomState(42)
+    labeled = sorted(labels)
+    holdout = [labeled[i] for i in np.sort(random.choice(len(labeled), int(len(labeled) * HOLDOUT_SHARE), replace=False))]
+    excluded = set(holdout)
+    ids = [x for x in sorted(covers.ids()) if x not in excluded]
+    if args.limit and args.limit < len(ids):
+        ids = [ids[i] for i in np.sort(random.choice(len(ids), args.limit, replace=False))]
+    print('distillation covers', len(ids), 'held out labeled covers', len(holdout))
+
+    teacher = cover_model.load_scorer(args.teacher)
+    cache = CoverCache(args.cache)
+    with metrics.timer('hash'):
+        hashes = covers.hashes(ids + holdout, cache)
+    targets = teacher_scores(teacher, covers, ids + holdout, hashes, cache)
+    cache.close()
+    # the covers that failed to decode have no teacher score
+    ids = [x for x in ids if x in targets]
+    holdout = [x for x in holdout if x in targets]
+
+    image_size = (args.image_size, args.image_size)
+    student = make_student(image_size, args.alpha)
+    student.compile(
+        optimizer=tf.keras.optimizers.Adam(LEARNING_RATE),
+        loss=tf.keras.losses.BinaryCrossentropy(),  # against the teacher probabilities, not 0 or 1
+        metrics=[tf.keras.metrics.MeanAbsoluteError()],
+        jit_compile=args.fast
+    )
+    student.summary()
+
+    train_ds = make_dataset(covers, ids, targets, image_size, args.batch_size, shuffle=True)
+    val_ds = make_dataset(covers, holdout, targets, image_size, args.batch_size, shuffle=False) if holdout else None
+    with metrics.timer('fit'):
+        student.fit(
+            train_ds,
+            epochs=args.epochs,
+            validation_data=val_ds,
+            callbacks=[
+                tf.keras.callbacks.EarlyStopping(monitor='val_loss' if holdout else 'loss', patience=2, restore_best_weights=True),
+                training.SpeedLog('distill', mode, args.batch_size),
+            ]
+        )
+    with metrics.timer('save'):
+        student.save(args.output)
+
+    # the report uses the saved student, loaded the same way as vgg_run.py does
+    student_scorer = cover_model.load_scorer(args.output)
+    report = {'teacher': args.teacher, 'student': args.output, 'image_size': args.image_size, 'covers': len(ids), 'holdout': len(holdout)}
+    if holdout:
+        student_scores = predict(student_scorer, covers, holdout)
+        holdout = [x for x in holdout if x in student_scores]
+        teacher_holdout = np.array([targets[x] for x in holdout])
+        student_holdout = np.array([student_scores[x] for x in holdout])
+        truth = [labels[x] for x in holdout]
+        report.update({
+            'teacher_auc': auc(truth, teacher_holdout),
+            'student_auc': auc(truth, student_holdout),
+            **compare(teacher_holdout, student_holdout),
+        })
+
+    sample = ids[:SPEED_SAMPLES]
+    _, teacher_seconds = score(teacher, [x.copy() for _, x in iter_batches(covers, sample, image_size=teacher.image_size)])
+    _, student_seconds = score(student_scorer, [x.copy() for _, x in iter_batches(covers, sample, image_size=student_scorer.image_size)])
+    covers.close()
+    report.update({
+        'teacher_images_per_sec': len(sample) / teacher_seconds,
+        'student_images_per_sec': len(sample) / student_seconds,
+        'speedup': teacher_seconds / student_seconds,
+    })
+    for key, value in report.items():
+        print(key, value)
+    with open(os.path.normpath(args.output) + '.json', 'w') as f:
+        json.dump(report, f, indent=4)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
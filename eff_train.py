@@ -1,6 +1,23 @@
 import tensorflow as tf
 import os
+import argparse
 from tensorflow.keras.applications.efficientnet import EfficientNetB0, preprocess_input
+import cover_tensors
+import feature_cache
+import metrics
+import training
+
+parser = argparse.ArgumentParser(prog='EfficientNet train')
+parser.add_argument('--tensors', help='folder prepared by cover_tensors.py, used instead of the images folder')
+parser.add_argument('--cached_features', action='store_true', help='train the head on stored EfficientNetB0 features (without augmentation) before fine-tuning')
+parser.add_argument('--fast', action='store_true', help='XLA, mixed precision where supported and cached preprocessed covers')
+parser.add_argument('--cache_file', help='cache the covers of --fast in files with this prefix instead of the memory')
+args = parser.parse_args()
+
+metrics.start_profile('eff_train')
+MODE = 'fast' if args.fast else 'baseline'
+if args.fast:
+    training.enable_mixed_precision()
 
 # Paths and parameters
 IMAGES_FOLDER = os.path.join('.', 'images')
@@ -10,25 +27,28 @@ BATCH_SIZE = 32
 NUM_EPOCHS = 15
 
 # Load datasets with validation split
-train_ds = tf.keras.utils.image_dataset_from_directory(
-    IMAGES_FOLDER,
-    label_mode='binary',
-    validation_split=0.2,
-    subset="training",
-    seed=42,
-    image_size=IMAGE_SIZE,
-    batch_size=BATCH_SIZE,
-)
-
-val_ds = tf.keras.utils.image_dataset_from_directory(
-    IMAGES_FOLDER,
-    label_mode='binary',
-    validation_split=0.2,
-    subset="validation",
-    seed=42,
-    image_size=IMAGE_SIZE,
-    batch_size=BATCH_SIZE,
-)
+if args.tensors:
+    train_ds, val_ds = cover_tensors.load_datasets(args.tensors, validation_split=0.2, seed=42, batch_size=BATCH_SIZE)
+else:
+    train_ds = tf.keras.utils.image_dataset_from_directory(
+        IMAGES_FOLDER,
+        label_mode='binary',
+        validation_split=0.2,
+        subset="training",
+        seed=42,
+        image_size=IMAGE_SIZE,
+        batch_size=BATCH_SIZE,
+    )
+
+    val_ds = tf.keras.utils.image_dataset_from_directory(
+        IMAGES_FOLDER,
+        label_mode='binary',
+        validation_split=0.2,
+        subset="validation",
+        seed=42,
+        image_size=IMAGE_SIZE,
+        batch_size=BATCH_SIZE,
+    )
 
 # Data augmentation pipeline (only for training data)
 data_augmentation = tf.keras.Sequential([
@@ -43,13 +63,13 @@ def augment_images(images, labels):
     images = data_augmentation(images)
     return images, labels
 
-train_ds = train_ds.map(lambda x, y: (preprocess_input(x), y))
-val_ds = val_ds.map(lambda x, y: (preprocess_input(x), y))
-
-train_ds = train_ds.map(augment_images, num_parallel_calls=AUTOTUNE)
-
-train_ds = train_ds.shuffle(1000).prefetch(buffer_size=AUTOTUNE)
-val_ds = val_ds.prefetch(buffer_size=AUTOTUNE)
+# The augmentation runs in the dataset map after the (cached) preprocessing, the prepared tensors are read from memory already
+preprocess = lambda x, y: (preprocess_input(x), y)
+train_cache = None if args.tensors else training.cache_file(args.cache_file, 'train')
+plain_train_ds = train_ds.map(preprocess)
+train_ds = training.prepare(train_ds, preprocess, args.fast, augment=augment_images, shuffle=True, cache=train_cache)
+val_ds = training.prepare(val_ds, preprocess, args.fast,
+                          cache=None if args.tensors else training.cache_file(args.cache_file, 'val'))
 
 # Load EfficientNetB0 base model with pretrained weights, exclude top layers
 base_model = EfficientNetB0(input_shape=IMAGE_SHAPE, include_top=False, weights='imagenet')
@@ -62,13 +82,14 @@ model = tf.keras.Sequential([
     tf.keras.layers.GlobalAveragePooling2D(),
     tf.keras.layers.Dense(64, activation='relu'),
     tf.keras.layers.Dropout(0.3),
-    tf.keras.layers.Dense(1, activation='sigmoid')
+    tf.keras.layers.Dense(1, activation='sigmoid', dtype='float32')  # float32 with mixed precision
 ])
 
 model.compile(
     optimizer=tf.keras.optimizers.Adam(),
     loss=tf.keras.losses.BinaryCrossentropy(),
-    metrics=["accuracy"]
+    metrics=["accuracy"],
+    jit_compile=args.fast
 )
 
 model.summary()
@@ -79,13 +100,39 @@ callbacks = [
     tf.keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.2, patience=2, min_lr=1e-7),
 ]
 
-# Initial training
-history = model.fit(
-    train_ds,
-    epochs=NUM_EPOCHS,
-    validation_data=val_ds,
-    callbacks=callbacks
-)
+if args.cached_features:
+    # The base model is frozen in the initial training, so its pooled output is calculated only once
+    extractor = tf.keras.Sequential([tf.keras.layers.InputLayer(input_shape=IMAGE_SHAPE), base_model, model.layers[1]])
+    source = args.tensors or IMAGES_FOLDER
+    with metrics.timer('features'):
+        train_features_ds = feature_cache.load_dataset(extractor, plain_train_ds, 'efficientnetb0-pooled-train', source, BATCH_SIZE, shuffle=True)
+        val_features_ds = feature_cache.load_dataset(extractor, val_ds, 'efficientnetb0-pooled-val', source, BATCH_SIZE, shuffle=False)
+
+    # The head shares its layers with the model, so the fine-tuning continues from the trained head
+    head = tf.keras.Sequential([tf.keras.layers.InputLayer(input_shape=extractor.output_shape[1:]), *model.layers[2:]])
+    head.compile(
+        optimizer=tf.keras.optimizers.Adam(),
+        loss=tf.keras.losses.BinaryCrossentropy(),
+        metrics=["accuracy"],
+        jit_compile=args.fast
+    )
+
+    with metrics.timer('fit'):
+        history = head.fit(
+            train_features_ds.prefetch(buffer_size=AUTOTUNE),
+            epochs=NUM_EPOCHS,
+            validation_data=val_features_ds.prefetch(buffer_size=AUTOTUNE),
+            callbacks=[*callbacks, training.SpeedLog('eff_train cached_features', MODE, BATCH_SIZE)]
+        )
+else:
+    # Initial training
+    with metrics.timer('fit'):
+        history = model.fit(
+            train_ds,
+            epochs=NUM_EPOCHS,
+            validation_data=val_ds,
+            callbacks=[*callbacks, training.SpeedLog('eff_train', MODE, BATCH_SIZE)]
+        )
 
 # Fine-tuning: unfreeze some layers and continue training with low LR
 base_model.trainable = True
@@ -97,24 +144,28 @@ for layer in base_model.layers[:fine_tune_at]:
 model.compile(
     optimizer=tf.keras.optimizers.Adam(1e-5),  # lower learning rate for fine-tuning
     loss=tf.keras.losses.BinaryCrossentropy(),
-    metrics=["accuracy"]
+    metrics=["accuracy"],
+    jit_compile=args.fast
 )
 
 fine_tune_epochs = 5
 total_epochs = NUM_EPOCHS + fine_tune_epochs
 
-history_fine = model.fit(
-    train_ds,
-    epochs=total_epochs,
-    initial_epoch=history.epoch[-1],
-    validation_data=val_ds,
-    callbacks=callbacks
-)
+with metrics.timer('fine-tune'):
+    history_fine = model.fit(
+        train_ds,
+        epochs=total_epochs,
+        initial_epoch=history.epoch[-1],
+        validation_data=val_ds,
+        callbacks=[*callbacks, training.SpeedLog('eff_train fine-tune', MODE, BATCH_SIZE)]
+    )
 
 # Save the trained model
-model.save(os.path.join('.', 'trained_binary_efficientnet'))
+with metrics.timer('save'):
+    model.save(os.path.join('.', 'trained_binary_efficientnet'))
 
 # Evaluate on validation dataset
-loss0, accuracy0 = model.evaluate(val_ds)
+with metrics.timer('evaluate'):
+    loss0, accuracy0 = model.evaluate(val_ds)
 print(f"Validation loss: {loss0:.4f}")
 print(f"Validation accuracy: {accuracy0:.4f}")
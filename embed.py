@@ -0,0 +1,131 @@
+# Cover embeddings with Img2Vec: the covers are decoded by a pool of threads of cover_images.py (the decoding
+# releases the GIL) a batch ahead, while the forward pass runs on the remaining cores
+
+import torch
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from tqdm import tqdm
+from img2vec import Img2Vec, batch_tensor, PREPROCESSING_VERSION
+from cover_cache import CoverCache, CACHE_FILE
+from cover_store import open_covers, COVERS_FOLDER
+from cover_images import CoverLoader
+import cover_model
+import embedding_store
+import metrics
+import shared
+
+FILES_FOLDER = shared.FILES_FOLDER
+RESULT_NAME = 'cover-cnn'
+BATCH_SIZE = 64
+CACHE_CHUNK_SIZE = 256
+
+
+def fingerprint(img2vec):
+    return 'torchvision:' + img2vec.model_name
+
+
+def embed_missing(img2vec, covers, ids, hashes, cache, batch_size=BATCH_SIZE, workers=None):
+    """ Calculates and caches the embeddings of the covers without a cached one, returns the number of embedded covers.
+    The covers that failed to decode are cached as FAILED, like vgg_run.py does, so they are not decoded again
+    """
+    missing = cache.missing({hashes[id] for id in ids}, fingerprint(img2vec), PREPROCESSING_VERSION)
+    pending = []
+    for id in ids:
+        if hashes[id] in missing:
+            pending.append(id)
+            missing.remove(hashes[id])
+    print('covers to embed', len(pending))
+    if not pending:
+        return 0
+
+    embedded = 0
+    failed = 0
+    started = time.perf_counter()
+    with CoverLoader(threads=workers) as loader:
+        # 'input' is the time the forward pass waits for the decoding threads
+        batches = metrics.timed('input', loader.batches(covers, pending, batch_size), lambda x: len(x[0]))
+        for chunk, images, ok in tqdm(batches, total=(len(pending) + batch_size - 1) // batch_size):
+            batch = [id for id, good in zip(chunk, ok) if good]
+            entries = [(hashes[id], cover_model.FAILED) for id, good in zip(chunk, ok) if not good]
+            if batch:
+                with metrics.timer('preprocess', len(batch)):
+                    tensor = batch_tensor(images if ok.all() else images[ok])
+                with metrics.timer('model', len(batch)):
+                    vectors = img2vec.get_vec(tensor)
+                entries += zip((hashes[id] for id in batch), vectors)
+            with metrics.timer('write', len(chunk)):
+                cache.put_many(entries, fingerprint(img2vec), PREPROCESSING_VERSION)
+                cache.commit()
+            embedded += len(batch)
+            failed += len(chunk) - len(batch)
+    elapsed = time.perf_counter() - started
+
+    print(f"embedded {embedded} images in {elapsed:.1f}s ({embedded / elapsed:.1f} images/sec), failed to decode {failed}")
+    return embedded
+
+
+def iter_embeddings(img2vec, ids, hashes, cache):
+    """ Yields (id, embedding) of the cached embeddings in the order of the ids
+    """
+    for start in range(0, len(ids), CACHE_CHUNK_SIZE):
+        chunk = ids[start:start + CACHE_CHUNK_SIZE]
+        cached = cache.get_many({hashes[id] for id in chunk}, fingerprint(img2vec), PREPROCESSING_VERSION)
+        for id in chunk:
+            vector = cached.get(hashes[id])
+            if vector is not None and not np.isnan(vector[0]):
+                yield id, vector
+
+
+def save(img2vec, ids, hashes, cache, result_name=RESULT_NAME, dtype=np.float16):
+    """ Saves the embeddings of the covers into <result_name>.npy with the ids in <result_name>.ids.json
+    """
+    missing = cache.missing({hashes[id] for id in ids}, fingerprint(img2vec), PREPROCESSING_VERSION)
+    missing |= cache.failed({hashes[id] for id in ids}, fingerprint(img2vec), PREPROCESSING_VERSION)
+    ids = [id for id in ids if hashes[id] not in missing]
+
+    items = ((str(id), vector) for id, vector in iter_embeddings(img2vec, ids, hashes, cache))
+    embedding_store.write(result_name, tqdm(items, total=len(ids)), len(ids), img2vec.layer_output_size, dtype,
+                          meta={'model': img2vec.model_name, 'preprocessing': PREPROCESSING_VERSION})
+    print('saved', len(ids), 'embeddings to', embedding_store.matrix_file(result_name))
+
+
+def main() -> int:
+    cpus = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(prog='Embed')
+    parser.add_argument('--model', default='resnet18', help='resnet18, resnet50, efficientnet_b0, densenet, ...')
+    parser.add_argument('--files', default=FILES_FOLDER)
+    parser.add_argument('--covers', default=COVERS_FOLDER, help='packed covers, the base64 files are read when there are none')
+    parser.add_argument('--result', default=RESULT_NAME, help='saved as <result>.npy and <result>.ids.json')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+    parser.add_argument('--cache', default=CACHE_FILE)
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=max(1, cpus // 4), help='decoding threads')
+    parser.add_argument('--threads', type=int, help='intra-op threads of the forward pass, all the cores left by the workers by default')
+    parser.add_argument('--interop_threads', type=int, default=1)
+    args = parser.parse_args()
+
+    metrics.start_profile('embed')
+    torch.set_num_threads(args.threads or max(1, cpus - args.workers))
+    torch.set_num_interop_threads(args.interop_threads)
+    print('threads', torch.get_num_threads(), 'workers', args.workers)
+
+    covers = open_covers(args.covers, args.files)
+    ids = sorted(covers.ids())
+    print('covers', len(ids))
+
+    img2vec = Img2Vec(model=args.model)
+    with CoverCache(args.cache) as cache, covers:
+        with metrics.timer('hash', len(ids)):
+            hashes = covers.hashes(ids, cache)
+        embed_missing(img2vec, covers, ids, hashes, cache, args.batch_size, args.workers)
+        with metrics.timer('save', len(ids)):
+            save(img2vec, ids, hashes, cache, args.result, np.dtype(args.dtype))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+# Embeddings saved as one <name>.npy matrix with the row ids in <name>.ids.json, the matrix
+# can be memory-mapped, so the readers only load the rows they need
+
+import numpy as np
+import os
+import json
+
+
+def matrix_file(name):
+    return name + '.npy'
+
+
+def ids_file(name):
+    return name + '.ids.json'
+
+
+def write(name, items, count, dim, dtype=np.float16, meta=None):
+    """ Writes (id, vector) items, there must be exactly count of them
+    """
+    matrix = np.lib.format.open_memmap(matrix_file(name) + '.tmp', mode='w+', dtype=dtype, shape=(count, dim))
+    ids = []
+    for id, vector in items:
+        matrix[len(ids)] = vector
+        ids.append(id)
+    if len(ids) != count:
+        raise ValueError(f'expected {count} embeddings, got {len(ids)}')
+    matrix.flush()
+    del matrix
+
+    with open(ids_file(name) + '.tmp', 'w') as f:
+        json.dump({**(meta or {}), 'dtype': np.dtype(dtype).name, 'ids': ids}, f)
+    os.replace(matrix_file(name) + '.tmp', matrix_file(name))
+    os.replace(ids_file(name) + '.tmp', ids_file(name))
+
+
+def version(name):
+    """ Size and modification time of the matrix, they change whenever the embeddings are written again
+    """
+    stat = os.stat(matrix_file(name))
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_ids(name):
+    with open(ids_file(name)) as f:
+        return json.load(f)['ids']
+
+
+def load_meta(name):
+    """ The meta passed to write (e.g. the model) and the dtype, without the ids
+    """
+    with open(ids_file(name)) as f:
+        meta = json.load(f)
+    meta.pop('ids')
+    return meta
+
+
+def load(name, ids=None, mmap=True):
+    """ Returns (ids, matrix), only the rows of the given ids (the ones that exist) when ids are passed
+    """
+    all_ids = load_ids(name)
+    matrix = np.load(matrix_file(name), mmap_mode='r' if mmap else None)
+    if ids is None:
+        return all_ids, matrix
+
+    index = {str(id): row for row, id in enumerate(all_ids)}
+    rows = [(id, index[str(id)]) for id in ids if str(id) in index]
+    return [id for id, _ in rows], matrix[np.array([row for _, row in rows], dtype=np.int64)]
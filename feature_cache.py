@@ -0,0 +1,65 @@
+# Activations of the frozen part of a model, calculated once and stored on disk, so the trainable
+# part can be trained on them for all epochs without running the backbone again
+
+import numpy as np
+import os
+import json
+import hashlib
+from tqdm import tqdm
+import cover_tensors
+
+FEATURES_FOLDER = os.path.join('.', 'features')
+
+
+def source_fingerprint(path):
+    """ Fingerprint of the training images, a file or a folder, by the names, sizes and mtimes
+    """
+    digest = hashlib.sha1()
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+    for file in files:
+        stat = os.stat(file)
+        digest.update(f'{os.path.relpath(file, path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+
+    return digest.hexdigest()[:16]
+
+
+def extract(extractor, ds, path, dtype=np.float16):
+    features_file = os.path.join(path, 'features.bin')
+    count = 0
+    labels = []
+    with open(features_file + '.tmp', 'wb') as f:
+        for x, y in tqdm(ds, desc='extracting features'):
+            batch = extractor.predict_on_batch(x)
+            f.write(np.asarray(batch, dtype=dtype).tobytes())
+            labels.extend(np.asarray(y).reshape(-1))
+            count += len(batch)
+
+    np.save(os.path.join(path, 'labels.npy'), np.array(labels, dtype=np.float32))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'shape': [count, *extractor.output_shape[1:]], 'dtype': np.dtype(dtype).name}, f)
+    os.replace(features_file + '.tmp', features_file)
+
+
+def load(extractor, ds, name, source, folder=FEATURES_FOLDER):
+    """ Memory-mapped features and labels of the dataset, extracted on the first call for the given source images
+    """
+    path = os.path.join(folder, f'{name}-{source_fingerprint(source)}')
+    if not os.path.isfile(os.path.join(path, 'features.bin')):
+        os.makedirs(path, exist_ok=True)
+        extract(extractor, ds, path)
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    features = np.memmap(os.path.join(path, 'features.bin'), dtype=meta['dtype'], mode='r', shape=tuple(meta['shape']))
+    labels = np.load(os.path.join(path, 'labels.npy'))
+    print('features', features.shape, 'from', path)
+    return features, labels
+
+
+def load_dataset(extractor, ds, name, source, batch_size, shuffle, folder=FEATURES_FOLDER):
+    features, labels = load(extractor, ds, name, source, folder)
+    return cover_tensors.make_dataset(features, labels, np.arange(len(labels)), batch_size, shuffle)
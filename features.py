@@ -0,0 +1,108 @@
+# Predictor features: the categories and tags of the books as multi-hot columns, built in one pass
+# over the rows with a stable vocabulary, which is saved next to the model. The columns are dense (one
+# uint8 column per category and tag, like the notebooks), sparse, or the tags are hashed into one
+# embedding feature of CatBoost
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import json
+import zlib
+from itertools import chain
+
+CATEGORY_PREFIX = 'cat-'
+TAG_PREFIX = 'tag-'
+REGULAR_COLUMNS = ['views', 'pages', 'chapters', 'score', 'votes', 'uploaded', 'cover']
+VOCABULARY_FILE = 'vocabulary.json'
+TAG_LAYOUTS = ['dense', 'sparse', 'hashed']
+HASH_SIZE = 256
+HASHED_TAGS_COLUMN = 'hashed-tags'
+
+
+def as_list(value):
+    return value if isinstance(value, (list, tuple, set)) else []
+
+
+def build_vocabulary(df):
+    return {
+        'categories': sorted(set(chain.from_iterable(as_list(x) for x in df['categories']))),
+        'tags': sorted(set(chain.from_iterable(as_list(x) for x in df['tags']))),
+    }
+
+
+def save_vocabulary(vocabulary, path=VOCABULARY_FILE):
+    with open(path, 'w') as f:
+        json.dump(vocabulary, f, indent=2)
+
+
+def load_vocabulary(path=VOCABULARY_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def multi_hot(values, vocabulary, dtype=np.uint8):
+    """ CSR matrix with a row per list of values and a column per vocabulary entry, unknown values are ignored
+    """
+    index = {value: i for i, value in enumerate(vocabulary)}
+    indptr = [0]
+    indices = []
+    for row in values:
+        indices.extend({index[x] for x in as_list(row) if x in index})
+        indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype=dtype)
+    return scipy.sparse.csr_matrix((data, np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+                                   shape=(len(indptr) - 1, len(vocabulary)))
+
+
+def category_columns(vocabulary):
+    return [CATEGORY_PREFIX + x for x in vocabulary['categories']]
+
+
+def tag_columns(vocabulary):
+    return [TAG_PREFIX + x for x in vocabulary['tags']]
+
+
+def hashed(values, size=HASH_SIZE):
+    """ (rows, size) float32 array with the counts of the values of each row hashed into size buckets, the
+    buckets do not depend on the vocabulary, so new values are not ignored
+    """
+    matrix = np.zeros((len(values), size), dtype=np.float32)
+    for i, row in enumerate(values):
+        for x in set(as_list(row)):
+            matrix[i, zlib.crc32(x.encode()) % size] += 1
+    return matrix
+
+
+def multi_hot_frame(df, vocabulary, sparse=False):
+    """ uint8 cat-* and tag-* columns for the rows of df, as one block. Sparse columns keep only the set values,
+    CatBoost trains on them without the dense matrix
+    """
+    matrix = scipy.sparse.hstack([
+        multi_hot(df['categories'], vocabulary['categories']),
+        multi_hot(df['tags'], vocabulary['tags']),
+    ], format='csr')
+    columns = [*category_columns(vocabulary), *tag_columns(vocabulary)]
+    if sparse:
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=df.index, columns=columns)
+    return pd.DataFrame(matrix.toarray(), index=df.index, columns=columns)
+
+
+def hashed_frame(df, vocabulary, size=HASH_SIZE):
+    """ Dense cat-* columns (there are few categories) and the tags hashed into one embedding column
+    """
+    frame = multi_hot_frame(df, {'categories': vocabulary['categories'], 'tags': []})
+    frame[HASHED_TAGS_COLUMN] = list(hashed(df['tags'].values, size))
+    return frame
+
+
+def tag_frame(df, vocabulary, layout='dense', hash_size=HASH_SIZE):
+    """ The categories and tags of the rows of df in one of the TAG_LAYOUTS
+    """
+    if layout == 'hashed':
+        return hashed_frame(df, vocabulary, hash_size)
+    return multi_hot_frame(df, vocabulary, sparse=layout == 'sparse')
+
+
+def add_multi_hot_columns(df, vocabulary):
+    return pd.concat([df, multi_hot_frame(df, vocabulary)], axis=1)
@@ -0,0 +1,115 @@
+# Mini-batch k-means (https://www.eecs.tufts.edu/~dsculley/papers/fastkmeans.pdf), trained from a
+# stream of batches, so the number of training vectors is not limited by memory
+
+import numpy as np
+
+ASSIGN_BLOCK_SIZE = 4096
+
+
+class CentroidIndex():
+    """ Nearest centroid search, ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2 with one matrix
+    multiplication per block of vectors instead of a loop over the vectors
+    """
+
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+    def assign(self, vectors, block_size=ASSIGN_BLOCK_SIZE):
+        """ Returns the nearest centroid index and the squared distance to it for every vector
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        labels = np.empty(len(vectors), dtype=np.int32)
+        distances = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            scores = block @ self.centroids.T
+            scores *= -2
+            scores += self.norms
+            nearest = np.argmin(scores, axis=1)
+            labels[start:start + len(block)] = nearest
+            distances[start:start + len(block)] = np.maximum(
+                scores[np.arange(len(block)), nearest] + np.einsum('ij,ij->i', block, block), 0)
+        return labels, distances
+
+
+class MiniBatchKMeans():
+    def __init__(self, n_clusters, seed=42):
+        self.n_clusters = n_clusters
+        self.random = np.random.RandomState(seed)
+        self.centroids = None
+        self.counts = None
+        self.index = None
+        self.init_buffer = []
+
+    def _init(self, vectors):
+        # k-means++ seeding on the first batch
+        centroids = [vectors[self.random.randint(len(vectors))]]
+        distances = np.sum((vectors - centroids[0]) ** 2, axis=1)
+        for _ in range(1, self.n_clusters):
+            total = distances.sum()
+            if total <= 0:
+                centroids.append(vectors[self.random.randint(len(vectors))])
+                continue
+            centroid = vectors[self.random.choice(len(vectors), p=distances / total)]
+            centroids.append(centroid)
+            np.minimum(distances, np.sum((vectors - centroid) ** 2, axis=1), out=distances)
+
+        self.centroids = np.array(centroids, dtype=np.float32)
+        self.counts = np.zeros(self.n_clusters, dtype=np.int64)
+        self.index = CentroidIndex(self.centroids)
+
+    def partial_fit(self, vectors):
+        """ Updates the centroids with a batch of vectors, returns the mean squared distance before the update
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.centroids is None:
+            # the seeding needs at least one vector per cluster
+            self.init_buffer.append(vectors)
+            if sum(len(x) for x in self.init_buffer) < self.n_clusters:
+                return None
+            vectors = np.concatenate(self.init_buffer)
+            self.init_buffer = []
+            self._init(vectors)
+
+        labels, distances = self.index.assign(vectors)
+
+        # every centroid moves to the running mean of all the vectors assigned to it so far
+        order = np.argsort(labels, kind='stable')
+        clusters, starts = np.unique(labels[order], return_index=True)
+        sums = np.add.reduceat(vectors[order], starts, axis=0)
+        sizes = np.diff(np.append(starts, len(vectors)))
+
+        self.counts[clusters] += sizes
+        rates = (sizes / self.counts[clusters]).astype(np.float32)[:, None]
+        self.centroids[clusters] += rates * (sums / sizes[:, None] - self.centroids[clusters])
+
+        # centroids that never got a vector are moved to random vectors of the batch
+        empty = np.flatnonzero(self.counts == 0)
+        if len(empty):
+            self.centroids[empty] = vectors[self.random.randint(len(vectors), size=len(empty))]
+
+        self.index = CentroidIndex(self.centroids)
+        return float(distances.mean())
+
+    def fit(self, make_batches, max_passes=10, tolerance=1e-3):
+        """ Runs passes over make_batches() until the mean squared distance stops improving
+        """
+        previous = None
+        for current_pass in range(max_passes):
+            inertia = [x for x in map(self.partial_fit, make_batches()) if x is not None]
+            if not inertia:
+                continue
+            inertia = float(np.mean(inertia))
+            print('pass', current_pass, 'mean squared distance', inertia)
+            if previous is not None and previous - inertia < tolerance * previous:
+                break
+            previous = inertia
+        return self
+
+    def save(self, path):
+        np.save(path, self.centroids)
+
+
+def load_codebook(path):
+    return np.load(path)
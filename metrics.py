@@ -0,0 +1,137 @@
+# Timers and counters for the stages of the scripts (read, decode, preprocess, model, write), printed as a
+# summary at exit. Everything is a no-op unless PIPELINE_METRICS=1 is set. PIPELINE_PROFILE=cprofile or
+# PIPELINE_PROFILE=tf also dumps a cProfile or TensorFlow profiler trace of the run into the profiles folder
+
+import os
+import sys
+import time
+import atexit
+
+METRICS_ENV = 'PIPELINE_METRICS'
+PROFILE_ENV = 'PIPELINE_PROFILE'
+PROFILE_FOLDER = os.path.join('.', 'profiles')
+
+profile = os.environ.get(PROFILE_ENV, '').lower()
+enabled = os.environ.get(METRICS_ENV, '') not in ('', '0') or bool(profile)
+
+# name -> [calls, seconds, items]
+timers = {}
+counters = {}
+
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer():
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        add_time(self.name, time.perf_counter() - self.started, self.items)
+        return False
+
+
+def add_time(name, seconds, items=1):
+    entry = timers.get(name)
+    if entry is None:
+        entry = timers[name] = [0, 0.0, 0]
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] += items
+
+
+def timer(name, items=1):
+    """ with timer('decode', len(batch)): ... adds the time of the block to the stage
+    """
+    return _Timer(name, items) if enabled else _null_timer
+
+
+def count(name, value=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + value
+
+
+def timed(name, iterable, items=None):
+    """ The iterable, with the time spent waiting for every element added to the stage. items(element)
+    gives the number of items in the element, e.g. the batch size
+    """
+    if not enabled:
+        return iterable
+
+    def wrapper():
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                return
+            add_time(name, time.perf_counter() - started, 1 if items is None else items(element))
+            yield element
+
+    return wrapper()
+
+
+def summary():
+    lines = []
+    total = sum(seconds for _, seconds, _ in timers.values())
+    for name, (calls, seconds, items) in sorted(timers.items(), key=lambda x: -x[1][1]):
+        share = seconds / total if total else 0
+        rate = f'{items / seconds:.1f}/sec' if seconds and items > calls else ''
+        lines.append(f'{name:<24} {seconds:10.3f}s {share:6.1%} {calls:8d} calls {items:10d} items {rate:>14}')
+    for name, value in sorted(counters.items()):
+        lines.append(f'{name:<24} {value}')
+    return '\n'.join(lines)
+
+
+def _report():
+    if timers or counters:
+        print('\nmetrics', file=sys.stderr)
+        print(summary(), file=sys.stderr)
+
+
+def start_profile(name):
+    """ Starts the profiler selected by PIPELINE_PROFILE for the rest of the run
+    """
+    if not profile:
+        return
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    path = os.path.join(PROFILE_FOLDER, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}')
+
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def stop():
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+            print('saved profile', path + '.prof', file=sys.stderr)
+    elif profile == 'tf':
+        import tensorflow as tf
+        tf.profiler.experimental.start(path)
+
+        def stop():
+            tf.profiler.experimental.stop()
+            print('saved profile', path, '(open with tensorboard --logdir)', file=sys.stderr)
+    else:
+        raise ValueError(f'{PROFILE_ENV} must be cprofile or tf, got {profile}')
+
+    atexit.register(stop)
+
+
+if enabled:
+    atexit.register(_report)
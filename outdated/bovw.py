@@ -1,45 +1,47 @@
 # https://archive.pinecone.io/learn/bag-of-visual-words/
 
 import numpy as np
-from PIL import Image
-from io import BytesIO
-import base64
 import os
 import cv2
 import matplotlib.pyplot as plt
-from scipy.cluster.vq import kmeans
-from scipy.cluster.vq import vq
+from multiprocessing import Pool
+from tqdm import tqdm
 import sys
 import json
 import argparse
 
-np.random.seed(42)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kmeans import MiniBatchKMeans, CentroidIndex, load_codebook
+from cover_store import open_covers
+import cover_images
 
-parser = argparse.ArgumentParser(prog='Bag of visual words')
-parser.add_argument('--vocabulary_size', type=int)
-parser.add_argument('--algorithm', type=ascii)
-args = parser.parse_args()
+np.random.seed(42)
 
 FILES_FOLDER = os.path.join('..', 'files')
+COVERS_FOLDER = os.path.join('..', 'covers')
 NUM_DESCRIPTORS_TO_TRAIN_KMEANS = 3000
-KMEANS_ITERATIONS = 1
-VOCABULARY_SIZE = args.vocabulary_size or 200
+KMEANS_PASSES = 10
+KMEANS_BATCH_SIZE = 20000
+VOCABULARY_SIZE = 200
 RESULT_FILE = 'cover-bovw.json'
+POOL_CHUNK_SIZE = 16
+
+extractor = None
+codebook_index = None
+covers = None
 
-algorithm = args.algorithm or 'sift'
-extractor = cv2.SIFT_create() if algorithm == 'sift' else cv2.ORB_create()
-files = [os.path.join(FILES_FOLDER, f) for f in os.listdir(FILES_FOLDER) if os.path.isfile(os.path.join(FILES_FOLDER, f))]
-print('files', len(files))
 
-def extract(file):
-    with open(file) as f:
-        contents = f.read()
+def init_worker(algorithm, cover_reader, codebook=None):
+    # OpenCV extractors can't be pickled, every worker process creates its own
+    global extractor, codebook_index, covers
+    covers = cover_reader
+    extractor = cv2.SIFT_create() if algorithm == 'sift' else cv2.ORB_create()
+    codebook_index = None if codebook is None else CentroidIndex(codebook)
 
-    # generate np arrays from the dataset images
-    image = np.array(Image.open(BytesIO(base64.b64decode(contents))))
 
-    # if RGB, transform into grayscale
-    bw_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+def extract(id):
+    # decode the images straight into grayscale at their resolution, a JPEG skips the color conversion
+    bw_image = cover_images.load(covers.read(id), None, 'L')
 
     # extract keypoints and descriptors
     img_keypoints, img_descriptors = extractor.detectAndCompute(bw_image, None)
@@ -51,97 +53,141 @@ def extract(file):
     if img_descriptors is None:
         return img_descriptors
 
-    return np.array(list(map(lambda x: x.astype(np.float32), img_descriptors)))
+    return img_descriptors.astype(np.float32)
 
-def train_kmeans():
-    # select 1000 random image index values
-    sample_idx = np.random.randint(0, len(files) + 1, NUM_DESCRIPTORS_TO_TRAIN_KMEANS).tolist()
 
-    # extract the sample from descriptors
-    descriptors = list(map(lambda i: extract(files[i]), sample_idx))
-    print('image descriptor shape', descriptors[0].shape)
+def word_counts(id):
+    """ Sparse visual word histogram of the image: (word indexes, counts), None when there are no descriptors
+    """
+    descriptor = extract(id)
+    if descriptor is None:
+        return None
 
-    all_descriptors = []
-    # extract image descriptor lists
-    for descriptor in descriptors:
-        # extract specific descriptors within the image
-        for value in descriptor:
-            all_descriptors.append(value)
+    # for each image, map each descriptor to the nearest codebook entry
+    img_visual_words, _ = codebook_index.assign(descriptor)
+    counts = np.bincount(img_visual_words, minlength=len(codebook_index.centroids))
+    words = np.flatnonzero(counts)
+    return words.astype(np.int32), counts[words].astype(np.float32)
 
-    # convert to single numpy array
-    all_descriptors = np.stack(all_descriptors)
-    print('descriptors shape for training', all_descriptors.shape)
 
-    codebook, _ = kmeans(all_descriptors, VOCABULARY_SIZE, KMEANS_ITERATIONS)
+def descriptor_batches(pool, ids, batch_size=KMEANS_BATCH_SIZE):
+    """ Descriptors of a fresh random sample of images, streamed in batches of batch_size rows
+    """
+    # select random image index values
+    sample_idx = np.random.randint(0, len(ids), NUM_DESCRIPTORS_TO_TRAIN_KMEANS).tolist()
+
+    batch = []
+    rows = 0
+    for descriptor in tqdm(pool.imap(extract, [ids[i] for i in sample_idx], chunksize=POOL_CHUNK_SIZE), total=len(sample_idx)):
+        if descriptor is None:
+            continue
+        batch.append(descriptor)
+        rows += len(descriptor)
+        if rows >= batch_size:
+            yield np.concatenate(batch)
+            batch = []
+            rows = 0
+    if batch:
+        yield np.concatenate(batch)
+
+
+def train_kmeans(pool, ids, vocabulary_size, passes=KMEANS_PASSES):
+    trainer = MiniBatchKMeans(vocabulary_size)
+    trainer.fit(lambda: descriptor_batches(pool, ids), max_passes=passes)
+    codebook = trainer.centroids
     print('codebook shape', codebook.shape)
 
     return codebook
 
-def calculate_word_freq(codebook):
-    files_to_remove = []
-    visual_words = []
-    # for ind in np.random.randint(0, len(files) + 1, NUM_DESCRIPTORS_TO_TRAIN_KMEANS * 10).tolist():
-    #     file = files[ind]
-    for file in files:
-        descriptor = extract(file)
-        if descriptor is None:
-            files_to_remove.append(file)
-            print('missing descriptor for', file)
+
+def calculate_word_freq(pool, ids):
+    """ Word frequencies of all the covers as CSR arrays (indptr, indices, data) and the ids with descriptors
+    """
+    indptr = [0]
+    indices = []
+    data = []
+    kept_ids = []
+    for id, counts in zip(ids, tqdm(pool.imap(word_counts, ids, chunksize=POOL_CHUNK_SIZE), total=len(ids))):
+        if counts is None:
+            print('missing descriptor for', id)
             continue
 
-        # for each image, map each descriptor to the nearest codebook entry
-        img_visual_words, _ = vq(descriptor, codebook)
-        visual_words.append(img_visual_words)
-    print('first image words', visual_words[0][:5], len(visual_words[0]))
-
-    for file in files_to_remove:
-        files.remove(file)
-
-    frequency_vectors = []
-    for img_visual_words in visual_words:
-        # create a frequency vector for each image
-        img_frequency_vector = np.zeros(VOCABULARY_SIZE)
-        for word in img_visual_words:
-            img_frequency_vector[word] += 1
-        frequency_vectors.append(img_frequency_vector)
-
-    # stack together in numpy array
-    result = np.stack(frequency_vectors)
-    print('frequency_vectors shape', result.shape)
-    return result
-
-def normalize(frequency_vectors):
-    df = np.sum(frequency_vectors > 0, axis=0)
+        words, frequencies = counts
+        indices.append(words)
+        data.append(frequencies)
+        indptr.append(indptr[-1] + len(words))
+        kept_ids.append(id)
+
+    indptr = np.array(indptr, dtype=np.int64)
+    indices = np.concatenate(indices)
+    data = np.concatenate(data)
+    print('frequency_vectors', (len(kept_ids), 'x', 'vocabulary'), 'non zero', len(data))
+    return (indptr, indices, data), kept_ids
+
+
+def normalize(frequency_vectors, vocabulary_size):
+    indptr, indices, data = frequency_vectors
+    # only the non zero frequencies are stored, so df is the number of times the word index occurs
+    df = np.bincount(indices, minlength=vocabulary_size)
     print('df', df.shape, df[:5])
 
-    idf = np.log(len(frequency_vectors) / df)
+    with np.errstate(divide='ignore'):
+        idf = np.log((len(indptr) - 1) / df)
     print('idf', idf.shape, idf[:5])
 
-    tfidf = frequency_vectors * idf
-    print('tfidf', tfidf.shape, tfidf[0][:5])
+    # in place, words with df = 0 have no entries
+    data *= idf[indices]
+    print('tfidf', data[indptr[0]:indptr[1]][:5])
 
-    return tfidf
+    return indptr, indices, data
 
-def save(tfidf):
-    result = {}
 
-    # indexes = np.random.randint(0, len(files) + 1, NUM_DESCRIPTORS_TO_TRAIN_KMEANS * 10).tolist()
-    # for ind in range(0, len(indexes)):
-    #     file = files[indexes[ind]]
-    for ind in range(0, len(files)):
-        file = files[ind]
-        file_name = os.path.basename(file)
-        result[file_name] = tfidf[ind].tolist()
+def save(tfidf, ids, vocabulary_size):
+    indptr, indices, data = tfidf
+    row = np.zeros(vocabulary_size, dtype=np.float32)
 
-    json_object = json.dumps(result, indent=4)
+    # written row by row, the dense matrix is never built
     with open(RESULT_FILE, "w") as outfile:
-        outfile.write(json_object)
+        outfile.write('{\n')
+        for ind in range(0, len(ids)):
+            row[:] = 0
+            row[indices[indptr[ind]:indptr[ind + 1]]] = data[indptr[ind]:indptr[ind + 1]]
+            separator = ',\n' if ind < len(ids) - 1 else '\n'
+            outfile.write(f'{json.dumps(ids[ind])}: {json.dumps(row.tolist())}{separator}')
+        outfile.write('}\n')
+
 
 def main() -> int:
-    codebook = train_kmeans()
-    frequency_vectors = calculate_word_freq(codebook)
-    tfidf = normalize(frequency_vectors)
-    save(tfidf)
+    parser = argparse.ArgumentParser(prog='Bag of visual words')
+    parser.add_argument('--vocabulary_size', type=int)
+    parser.add_argument('--algorithm', type=ascii)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--passes', type=int, default=KMEANS_PASSES)
+    parser.add_argument('--codebook', help='codebook file, trained and saved when it does not exist')
+    args = parser.parse_args()
+
+    vocabulary_size = args.vocabulary_size or VOCABULARY_SIZE
+    algorithm = (args.algorithm or 'sift').replace("'", "")
+    codebook_file = args.codebook or f'codebook-{algorithm}-{vocabulary_size}.npy'
+
+    covers = open_covers(COVERS_FOLDER, FILES_FOLDER)
+    ids = sorted(covers.ids())
+    print('covers', len(ids))
+
+    if os.path.isfile(codebook_file):
+        codebook = load_codebook(codebook_file)
+        print('loaded codebook', codebook_file, codebook.shape)
+    else:
+        with Pool(args.workers, initializer=init_worker, initargs=(algorithm, covers)) as pool:
+            codebook = train_kmeans(pool, ids, vocabulary_size, args.passes)
+        np.save(codebook_file, codebook)
+    vocabulary_size = len(codebook)
+
+    with Pool(args.workers, initializer=init_worker, initargs=(algorithm, covers, codebook)) as pool:
+        frequency_vectors, ids = calculate_word_freq(pool, ids)
+
+    tfidf = normalize(frequency_vectors, vocabulary_size)
+    save(tfidf, ids, vocabulary_size)
 
     # plt.bar(list(range(VOCABULARY_SIZE)), frequency_vectors[0])
     # plt.show()
@@ -152,4 +198,4 @@ def main() -> int:
     return 0
 
 if __name__ == '__main__':
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
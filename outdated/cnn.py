@@ -1,251 +1,33 @@
-# https://github.com/christiansafka/img2vec/blob/master/img2vec_pytorch/img_to_vec.py
-
-import torch
-import torchvision.models as models
-import torchvision.transforms as transforms
 import argparse
-from io import BytesIO
-import base64
 import os
-import json
-from tqdm import tqdm
-from PIL import Image
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cover_cache import CoverCache
+from cover_store import open_covers
+from img2vec import Img2Vec
+import embed
+import metrics
 
 parser = argparse.ArgumentParser(prog='CNN')
 parser.add_argument('--model', type=ascii)
 args = parser.parse_args()
 
-FILES_FOLDER = os.path.join('..', 'files')
-RESULT_FILE = 'cover-cnn.json'
-
-files = [os.path.join(FILES_FOLDER, f) for f in os.listdir(FILES_FOLDER) if os.path.isfile(os.path.join(FILES_FOLDER, f))]
-print('files', len(files))
-
-class Img2Vec():
-    RESNET_OUTPUT_SIZES = {
-        'resnet18': 512,
-        'resnet34': 512,
-        'resnet50': 2048,
-        'resnet101': 2048,
-        'resnet152': 2048
-    }
-
-    EFFICIENTNET_OUTPUT_SIZES = {
-        'efficientnet_b0': 1280,
-        'efficientnet_b1': 1280,
-        'efficientnet_b2': 1408,
-        'efficientnet_b3': 1536,
-        'efficientnet_b4': 1792,
-        'efficientnet_b5': 2048,
-        'efficientnet_b6': 2304,
-        'efficientnet_b7': 2560
-    }
-
-    def __init__(self, cuda=False, model='resnet-18', layer='default', layer_output_size=512, gpu=0):
-        """ Img2Vec
-        :param cuda: If set to True, will run forward pass on GPU
-        :param model: String name of requested model
-        :param layer: String or Int depending on model.  See more docs: https://github.com/christiansafka/img2vec.git
-        :param layer_output_size: Int depicting the output size of the requested layer
-        """
-        self.device = torch.device(f"cuda:{gpu}" if cuda else "cpu")
-        self.layer_output_size = layer_output_size
-        self.model_name = model
-
-        self.model, self.extraction_layer = self._get_model_and_layer(model, layer)
-
-        self.model = self.model.to(self.device)
-
-        self.model.eval()
-
-        self.scaler = transforms.Resize((224, 224))
-        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                              std=[0.229, 0.224, 0.225])
-        self.to_tensor = transforms.ToTensor()
-
-    def get_vec(self, img, tensor=False):
-        """ Get vector embedding from PIL image
-        :param img: PIL Image or list of PIL Images
-        :param tensor: If True, get_vec will return a FloatTensor instead of Numpy array
-        :returns: Numpy ndarray
-        """
-        if type(img) == list:
-            a = [self.normalize(self.to_tensor(self.scaler(im))) for im in img]
-            images = torch.stack(a).to(self.device)
-            if self.model_name in ['alexnet', 'vgg']:
-                my_embedding = torch.zeros(len(img), self.layer_output_size)
-            elif self.model_name == 'densenet' or 'efficientnet' in self.model_name:
-                my_embedding = torch.zeros(len(img), self.layer_output_size, 7, 7)
-            else:
-                my_embedding = torch.zeros(len(img), self.layer_output_size, 1, 1)
-
-            def copy_data(m, i, o):
-                my_embedding.copy_(o.data)
-
-            h = self.extraction_layer.register_forward_hook(copy_data)
-            with torch.no_grad():
-                h_x = self.model(images)
-            h.remove()
-
-            if tensor:
-                return my_embedding
-            else:
-                if self.model_name in ['alexnet', 'vgg']:
-                    return my_embedding.numpy()[:, :]
-                elif self.model_name == 'densenet' or 'efficientnet' in self.model_name:
-                    return torch.mean(my_embedding, (2, 3), True).numpy()[:, :, 0, 0]
-                else:
-                    return my_embedding.numpy()[:, :, 0, 0]
-        else:
-            image = self.normalize(self.to_tensor(self.scaler(img))).unsqueeze(0).to(self.device)
-
-            if self.model_name in ['alexnet', 'vgg']:
-                my_embedding = torch.zeros(1, self.layer_output_size)
-            elif self.model_name == 'densenet' or 'efficientnet' in self.model_name:
-                my_embedding = torch.zeros(1, self.layer_output_size, 7, 7)
-            else:
-                my_embedding = torch.zeros(1, self.layer_output_size, 1, 1)
-
-            def copy_data(m, i, o):
-                my_embedding.copy_(o.data)
-
-            h = self.extraction_layer.register_forward_hook(copy_data)
-            with torch.no_grad():
-                h_x = self.model(image)
-            h.remove()
-
-            if tensor:
-                return my_embedding
-            else:
-                if self.model_name in ['alexnet', 'vgg']:
-                    return my_embedding.numpy()[0, :]
-                elif self.model_name == 'densenet':
-                    return torch.mean(my_embedding, (2, 3), True).numpy()[0, :, 0, 0]
-                else:
-                    return my_embedding.numpy()[0, :, 0, 0]
-
-    def _get_model_and_layer(self, model_name, layer):
-        print('model_name', model_name, model_name == 'resnet-18')
-        """ Internal method for getting layer from model
-        :param model_name: model name such as 'resnet-18'
-        :param layer: layer as a string for resnet-18 or int for alexnet
-        :returns: pytorch model, selected layer
-        """
+metrics.start_profile('cnn')
 
-        if model_name.startswith('resnet') and not model_name.startswith('resnet-'):
-            model = getattr(models, model_name)(pretrained=True)
-            if layer == 'default':
-                layer = model._modules.get('avgpool')
-                self.layer_output_size = self.RESNET_OUTPUT_SIZES[model_name]
-            else:
-                layer = model._modules.get(layer)
-            return model, layer
-        elif model_name == 'resnet-18':
-            model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
-            if layer == 'default':
-                layer = model._modules.get('avgpool')
-                self.layer_output_size = 512
-            else:
-                layer = model._modules.get(layer)
-
-            return model, layer
-
-        elif model_name == 'alexnet':
-            model = models.alexnet(pretrained=True)
-            if layer == 'default':
-                layer = model.classifier[-2]
-                self.layer_output_size = 4096
-            else:
-                layer = model.classifier[-layer]
-
-            return model, layer
-
-        elif model_name == 'vgg':
-            # VGG-11
-            model = models.vgg11_bn(pretrained=True)
-            if layer == 'default':
-                layer = model.classifier[-2]
-                self.layer_output_size = model.classifier[-1].in_features # should be 4096
-            else:
-                layer = model.classifier[-layer]
-
-            return model, layer
-
-        elif model_name == 'densenet':
-            # Densenet-121
-            model = models.densenet121(pretrained=True)
-            if layer == 'default':
-                layer = model.features[-1]
-                self.layer_output_size = model.classifier.in_features # should be 1024
-            else:
-                raise KeyError('Un support %s for layer parameters' % model_name)
-
-            return model, layer
-
-        elif "efficientnet" in model_name:
-            # efficientnet-b0 ~ efficientnet-b7
-            if model_name == "efficientnet_b0":
-                model = models.efficientnet_b0(pretrained=True)
-            elif model_name == "efficientnet_b1":
-                model = models.efficientnet_b1(pretrained=True)
-            elif model_name == "efficientnet_b2":
-                model = models.efficientnet_b2(pretrained=True)
-            elif model_name == "efficientnet_b3":
-                model = models.efficientnet_b3(pretrained=True)
-            elif model_name == "efficientnet_b4":
-                model = models.efficientnet_b4(pretrained=True)
-            elif model_name == "efficientnet_b5":
-                model = models.efficientnet_b5(pretrained=True)
-            elif model_name == "efficientnet_b6":
-                model = models.efficientnet_b6(pretrained=True)
-            elif model_name == "efficientnet_b7":
-                model = models.efficientnet_b7(weights=models.EfficientNet_B7_Weights.DEFAULT)
-            else:
-                raise KeyError('Un support %s.' % model_name)
-
-            if layer == 'default':
-                layer = model.features
-                self.layer_output_size = self.EFFICIENTNET_OUTPUT_SIZES[model_name]
-            else:
-                raise KeyError('Un support %s for layer parameters' % model_name)
-
-            return model, layer
+FILES_FOLDER = os.path.join('..', 'files')
+RESULT_NAME = 'cover-cnn'
+CACHE_FILE = os.path.join('..', 'cover-cache.sqlite')
+COVERS_FOLDER = os.path.join('..', 'covers')
 
-        else:
-            raise KeyError('Model %s was not found' % model_name)
+covers = open_covers(COVERS_FOLDER, FILES_FOLDER)
+ids = sorted(covers.ids())
+print('covers', len(ids))
 
-model = None if args.model is None else args.model.replace("'", "")
+model = 'resnet-18' if args.model is None else args.model.replace("'", "")
 img2Vec = Img2Vec(model=model)
 
-result = []
-chunk = 0
-
-def save():
-    global result
-    global chunk
-    json_object = json.dumps(result, indent=4)
-    result_file_name = (str(chunk) + '.').join(RESULT_FILE.split('.'))
-    with open(result_file_name, "w") as outfile:
-        outfile.write(json_object)
-    result = []
-    chunk = chunk + 1
-
-for file in tqdm(files):
-    file_name = os.path.basename(file)
-
-    with open(file) as f:
-        contents = f.read()
-
-    image = Image.open(BytesIO(base64.b64decode(contents))).convert('RGB')
-
-    item = {}
-    item['id'] = file_name
-    item['cover'] = img2Vec.get_vec(image).tolist()
-
-    result.append(item)
-
-    size = (len(result) * 20 * img2Vec.layer_output_size) / 1024 / 1024
-    if size > 1000:
-        save()
-
-save()
+with CoverCache(CACHE_FILE) as cache, covers:
+    hashes = covers.hashes(ids, cache)
+    embed.embed_missing(img2Vec, covers, ids, hashes, cache)
+    embed.save(img2Vec, ids, hashes, cache, RESULT_NAME)
@@ -2,22 +2,24 @@
 
 import torch
 import torchvision.models as models
-import torchvision.transforms as transforms
-from torch.autograd import Variable
-from PIL import Image
-from io import BytesIO
-import base64
 import os
 import json
-import cv2
-import numpy as np
 from tqdm import tqdm
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cover_store import open_covers
+from cover_images import CoverLoader
+from img2vec import batch_tensor
 
 FILES_FOLDER = os.path.join('..', 'files')
 RESULT_FILE = 'cover-cnn.json'
+COVERS_FOLDER = os.path.join('..', 'covers')
+BATCH_SIZE = 32
 
-files = [os.path.join(FILES_FOLDER, f) for f in os.listdir(FILES_FOLDER) if os.path.isfile(os.path.join(FILES_FOLDER, f))]
-print('files', len(files))
+covers = open_covers(COVERS_FOLDER, FILES_FOLDER)
+ids = sorted(covers.ids())
+print('covers', len(ids))
 
 # Load the pretrained model
 model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
@@ -28,56 +30,41 @@ layer = model._modules.get('avgpool')
 # Set model to evaluation mode
 model.eval()
 
-scaler = transforms.Resize((224, 224))
-normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225])
-to_tensor = transforms.ToTensor()
-
-def extract(file):
-    with open(file) as f:
-        contents = f.read()
-
-
-    # 1. Load the image with Pillow library
-    image = np.array(Image.open(BytesIO(base64.b64decode(contents))))
+def extract(images):
+    # 1. Create the normalized batch tensor of the covers decoded by cover_images.py
+    t_img = batch_tensor(images)
 
-    # if grayscale, transform into RGB
-    rgb_image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB) if len(image.shape) != 3 else image
-    img = Image.fromarray(rgb_image)
-
-    # 2. Create a PyTorch Variable with the transformed image
-    t_img = Variable(normalize(to_tensor(scaler(img))).unsqueeze(0))
-
-    # 3. Create a vector of zeros that will hold our feature vector
+    # 2. Create a matrix of zeros that will hold our feature vectors
     #    The 'avgpool' layer has an output size of 512
-    my_embedding = torch.zeros(512)
+    my_embedding = torch.zeros(len(images), 512)
 
-    # 4. Define a function that will copy the output of a layer
+    # 3. Define a function that will copy the output of a layer
     def copy_data(m, i, o):
-        my_embedding.copy_(o.data.reshape(o.data.size(1)))
+        my_embedding.copy_(o.data.reshape(len(images), o.data.size(1)))
 
-    # 5. Attach that function to our selected layer
+    # 4. Attach that function to our selected layer
     h = layer.register_forward_hook(copy_data)
 
-    # 6. Run the model on our transformed image
-    model(t_img)
+    # 5. Run the model on our transformed images
+    with torch.no_grad():
+        model(t_img)
 
-    # 7. Detach our copy function from the layer
+    # 6. Detach our copy function from the layer
     h.remove()
 
-    # 8. Return the feature vector
+    # 7. Return the feature vectors
     return my_embedding
 
 result = []
 
-for file in tqdm(files):
-    file_name = os.path.basename(file)
-
-    item = {}
-    item['id'] = file_name
-    item['cover'] = extract(file).cpu().numpy().tolist()
+with CoverLoader() as loader:
+    for chunk, images, ok in tqdm(loader.batches(covers, ids, BATCH_SIZE), total=(len(ids) + BATCH_SIZE - 1) // BATCH_SIZE):
+        for id, vector in zip([x for x, good in zip(chunk, ok) if good], extract(images[ok]).cpu().numpy()):
+            item = {}
+            item['id'] = id
+            item['cover'] = vector.tolist()
 
-    result.append(item)
+            result.append(item)
 
 json_object = json.dumps(result, indent=4)
 with open(RESULT_FILE, "w") as outfile:
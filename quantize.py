@@ -0,0 +1,121 @@
+# Converts a saved cover model (trained_binary_vgg or trained_binary_efficientnet) to a reduced precision
+# TFLite model for scoring on CPU, then compares its scores and speed with the float model on a sample of covers
+
+import tensorflow as tf
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+from scipy.stats import spearmanr
+from cover_store import open_covers, COVERS_FOLDER, FILES_FOLDER
+import cover_model
+from cover_model import KerasScorer, TFLiteScorer
+
+MODES = ['dynamic', 'float16', 'int8']
+CALIBRATION_SAMPLES = 200
+EVALUATION_SAMPLES = 256
+# Share of the highest scores that is compared between the models
+TOP_SHARE = 0.1
+
+
+def output_file(model_folder, mode):
+    return os.path.normpath(model_folder) + f'.{mode}.tflite'
+
+
+def sample_batches(covers, count, seed):
+    """ Decoded covers of a random sample of count ids, as a list of numpy batches
+    """
+    ids = sorted(covers.ids())
+    ids = [ids[i] for i in np.sort(np.random.RandomState(seed).choice(len(ids), min(count, len(ids)), replace=False))]
+    # the batches of iter_batches are reused, they are copied
+    return [images.copy() for _, images in cover_model.iter_batches(covers, ids)]
+
+
+def convert(model_folder, mode, calibration=None):
+    """ dynamic: int8 weights, float activations. float16: float16 weights. int8: int8 weights and
+    activations, with the activation ranges calibrated on the given batches. The input and output stay float32
+    """
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_folder)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        def representative_dataset():
+            for batch in calibration:
+                for image in batch:
+                    yield [image[None].astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+def score(scorer, batches):
+    # the first batch also builds the model or allocates the interpreter, it is not timed
+    scorer.predict(batches[0])
+    started = time.perf_counter()
+    scores = np.concatenate([scorer.predict(batch)[:, 0] for batch in batches])
+    return scores, time.perf_counter() - started
+
+
+def compare(reference, scores):
+    difference = np.abs(reference - scores)
+    top = max(1, int(len(reference) * TOP_SHARE))
+    # undefined when one of the models gives the same score to every cover
+    spearman = spearmanr(reference, scores).correlation
+    return {
+        'mean_abs_difference': float(difference.mean()),
+        'max_abs_difference': float(difference.max()),
+        'spearman': None if np.isnan(spearman) else float(spearman),
+        'top_overlap': len(set(np.argsort(-reference)[:top]) & set(np.argsort(-scores)[:top])) / top,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Quantize')
+    parser.add_argument('--model', default=cover_model.MODEL_FOLDER, help='saved model folder')
+    parser.add_argument('--mode', default='dynamic', choices=MODES)
+    parser.add_argument('--output', help='<model>.<mode>.tflite by default')
+    parser.add_argument('--covers', default=COVERS_FOLDER)
+    parser.add_argument('--files', default=FILES_FOLDER)
+    parser.add_argument('--calibration_samples', type=int, default=CALIBRATION_SAMPLES)
+    parser.add_argument('--samples', type=int, default=EVALUATION_SAMPLES, help='covers scored by both models for the report')
+    parser.add_argument('--threads', type=int, help='threads of the TFLite interpreter')
+    args = parser.parse_args()
+
+    output = args.output or output_file(args.model, args.mode)
+    covers = open_covers(args.covers, args.files)
+
+    calibration = sample_batches(covers, args.calibration_samples, seed=0) if args.mode == 'int8' else None
+    started = time.perf_counter()
+    with open(output, 'wb') as f:
+        f.write(convert(args.model, args.mode, calibration))
+    print('converted', output, f'in {time.perf_counter() - started:.1f}s',
+          f'{os.path.getsize(output) / 2 ** 20:.1f} MB')
+
+    batches = sample_batches(covers, args.samples, seed=1)
+    covers.close()
+    count = sum(len(x) for x in batches)
+    reference, reference_seconds = score(KerasScorer(args.model), batches)
+    scores, seconds = score(TFLiteScorer(output, args.threads), batches)
+
+    report = {
+        'model': args.model,
+        'mode': args.mode,
+        'samples': count,
+        **compare(reference, scores),
+        'float_images_per_sec': count / reference_seconds,
+        'quantized_images_per_sec': count / seconds,
+        'speedup': reference_seconds / seconds,
+    }
+    for key, value in report.items():
+        print(key, value)
+    with open(output + '.json', 'w') as f:
+        json.dump(report, f, indent=4)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
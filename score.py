@@ -0,0 +1,159 @@
+# Scores the unlabeled books with the predictor saved by train.py. The model is loaded once, the books
+# are scored in large batches, and in the serve mode the scores of single books are returned on request
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from catboost import CatBoostClassifier
+import embedding_store
+import features
+import train
+
+BATCH_SIZE = 50000
+PORT = 8765
+
+
+class Scorer():
+    def __init__(self, model_file, data_file, covers_file, threads=-1):
+        self.threads = threads
+        self.model = CatBoostClassifier()
+        self.model.load_model(model_file)
+        self.vocabulary = features.load_vocabulary(train.vocabulary_file(model_file))
+        self.regular_columns = self.vocabulary['regular']
+        self.data_file = data_file
+        self.covers_file = covers_file if 'cover' in self.regular_columns else None
+        # the layout of the tags is read from the vocabulary by train.feature_matrix, the cover embeddings
+        # are loaded when the model was trained with them
+        self.embeddings = self.vocabulary.get('embeddings')
+        self.version = None
+        self.reload()
+
+    def reload(self):
+        """ Reloads the books when the data files changed since the last load
+        """
+        files = [x for x in [self.data_file, self.covers_file] if x]
+        if self.embeddings:
+            files.append(embedding_store.matrix_file(self.embeddings))
+        version = [os.stat(x).st_mtime_ns for x in files]
+        if version == self.version:
+            return
+        self.full = train.load_frame(self.data_file, self.covers_file, self.embeddings).set_index('id', drop=False)
+        self.version = version
+
+    def score_frame(self, frame, batch_size=BATCH_SIZE):
+        scores = np.empty(len(frame), dtype=np.float64)
+        for start in range(0, len(frame), batch_size):
+            batch = frame.iloc[start:start + batch_size]
+            X = train.feature_matrix(batch, self.vocabulary, self.regular_columns)
+            scores[start:start + len(batch)] = self.model.predict_proba(X, thread_count=self.threads)[:, 1]
+        return scores
+
+    def score_ids(self, ids):
+        self.reload()
+        known = [x for x in ids if x in self.full.index]
+        scores = self.score_frame(self.full.loc[known]) if known else []
+        return {str(id): float(score) for id, score in zip(known, scores)}
+
+    def top(self, k):
+        self.reload()
+        unlabeled = self.full[self.full['label'].isna()]
+        started = time.perf_counter()
+        scores = self.score_frame(unlabeled)
+        elapsed = time.perf_counter() - started
+        print(f"scored {len(unlabeled)} books in {elapsed:.1f}s", file=sys.stderr)
+        top = train.top_k(scores, k)
+        return list(unlabeled['name'].values[top]), scores[top]
+
+
+def parse_ids(values):
+    return [int(x) if str(x).isdigit() else x for x in values]
+
+
+def serve_stdin(scorer, output):
+    # One request per line: a JSON list of ids, or {"top": k}, one JSON response per line on output
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict) and 'top' in request:
+                names, scores = scorer.top(int(request['top']))
+                response = [{'name': name, 'score': float(score)} for name, score in zip(names, scores)]
+            else:
+                response = scorer.score_ids(parse_ids(request))
+        except Exception as ex:
+            response = {'error': str(ex)}
+        print(json.dumps(response), file=output, flush=True)
+
+
+def serve_http(scorer, port):
+    class Handler(BaseHTTPRequestHandler):
+        # GET /score?ids=1,2,3 or /top?k=20
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            try:
+                if url.path == '/score':
+                    ids = [x for value in query.get('ids', []) for x in value.split(',') if x]
+                    response = scorer.score_ids(parse_ids(ids))
+                elif url.path == '/top':
+                    names, scores = scorer.top(int(query.get('k', [train.RESULT_SIZE])[0]))
+                    response = [{'name': name, 'score': float(score)} for name, score in zip(names, scores)]
+                else:
+                    self.send_error(404)
+                    return
+            except Exception as ex:
+                self.send_error(500, str(ex))
+                return
+
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print('serving on', f'http://127.0.0.1:{port}', file=sys.stderr)
+    server.serve_forever()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Score')
+    parser.add_argument('--data', default=train.DATA_FILE)
+    parser.add_argument('--covers', default=train.COVERS_FILE)
+    parser.add_argument('--model', default=train.MODEL_FILE)
+    parser.add_argument('--result', default=train.RESULT_FILE)
+    parser.add_argument('--result_size', type=int, default=train.RESULT_SIZE)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--serve', choices=['stdin', 'http'])
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    # stdout carries the responses in the stdin mode, the progress goes to stderr
+    output = sys.stdout
+    if args.serve == 'stdin':
+        sys.stdout = sys.stderr
+
+    scorer = Scorer(args.model, args.data, args.covers, args.threads)
+
+    if args.serve == 'stdin':
+        serve_stdin(scorer, output)
+    elif args.serve == 'http':
+        serve_http(scorer, args.port)
+    else:
+        names, _ = scorer.top(args.result_size)
+        with open(args.result, "w") as outfile:
+            json.dump(train.result_names(names), outfile)
+        print('saved', args.result)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+
+RESULT_FILE = 'cover-score.json'
+STORE_FILE = 'cover-score.jsonl'
+
+
+class ScoreStore():
+    """ Base class for the cover score stores, the scores are kept per book id, the last write wins
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.changed = False
+
+    def ids(self):
+        return self.scores.keys()
+
+    def items(self):
+        return self.scores.items()
+
+    def get(self, id):
+        return self.scores.get(id)
+
+    def add(self, id, cover):
+        raise NotImplementedError()
+
+    def flush(self):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush()
+
+    def __len__(self):
+        return len(self.ids())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def import_json(self, path):
+        """ Import the scores from the legacy cover-score.json format
+        """
+        with open(path) as f:
+            result = json.load(f)
+        for entry in result:
+            self.add(entry['id'], entry['cover'])
+        self.flush()
+        return len(result)
+
+    def export_json(self, path=RESULT_FILE):
+        """ Export the scores to the cover-score.json format used by the notebooks
+        """
+        result = [{'id': id, 'cover': cover} for id, cover in self.items()]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(result, outfile, indent=4)
+        os.replace(tmp_path, path)
+        return len(result)
+
+
+class JsonLinesScoreStore(ScoreStore):
+    """ Append-only JSON Lines file, one {"id": ..., "cover": ...} object per line
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.pending = []
+        if os.path.isfile(path):
+            self._load()
+        self.file = open(path, 'a')
+
+    def _load(self):
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                # A line without the newline was torn by a crash in the middle of a write
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                self.scores[entry['id']] = entry['cover']
+                offset += len(line)
+
+        if offset != os.path.getsize(self.path):
+            print('dropping incomplete tail of', self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def add(self, id, cover):
+        self.scores[id] = cover
+        self.changed = True
+        self.pending.append(json.dumps({'id': id, 'cover': cover}) + '\n')
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.file.write(''.join(self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class SqliteScoreStore(ScoreStore):
+    """ SQLite table keyed by book id
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS scores (id PRIMARY KEY, cover REAL NOT NULL)')
+        self.connection.commit()
+        self.scores = dict(self.connection.execute('SELECT id, cover FROM scores ORDER BY rowid'))
+        self.pending = []
+
+    def add(self, id, cover):
+        self.scores[id] = cover
+        self.changed = True
+        self.pending.append((id, cover))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO scores (id, cover) VALUES (?, ?)', self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def shard_file(path, shard, shards):
+    """ The store of one shard of a sharded run, e.g. cover-score.shard-0-of-4.jsonl
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard-{shard}-of-{shards}{ext}'
+
+
+def merge_shards(store, path, shards):
+    """ Adds the scores of every shard store to the store, returns the number of changed scores
+    """
+    paths = [shard_file(path, shard, shards) for shard in range(shards)]
+    missing = [x for x in paths if not os.path.isfile(x)]
+    if missing:
+        raise FileNotFoundError(f'missing shard stores: {", ".join(missing)}')
+
+    changed = 0
+    for shard_path in paths:
+        with open_store(shard_path, None) as shard:
+            for id, cover in shard.items():
+                if store.get(id) != cover:
+                    store.add(id, cover)
+                    changed += 1
+    store.flush()
+    return changed
+
+
+def open_store(path=STORE_FILE, legacy_file=RESULT_FILE):
+    """ Open the store matching the file extension, an empty store is seeded from the legacy result file
+    """
+    if path.endswith('.sqlite') or path.endswith('.db'):
+        store = SqliteScoreStore(path)
+    else:
+        store = JsonLinesScoreStore(path)
+
+    if not len(store) and legacy_file and os.path.isfile(legacy_file):
+        print('importing', legacy_file, store.import_json(legacy_file))
+
+    return store
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Score store')
+    parser.add_argument('--store', default=STORE_FILE)
+    parser.add_argument('--export', default=RESULT_FILE)
+    args = parser.parse_args()
+
+    with open_store(args.store) as store:
+        print('exported', store.export_json(args.export))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
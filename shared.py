@@ -0,0 +1,162 @@
+# Data access shared by the Python scripts, the counterpart of shared.ts: books are streamed out of
+# db.json (keyed by name) or data.json (a list) without loading the whole file, and the files folder
+# is listed once instead of checking every id
+
+import os
+import json
+import zlib
+import pickle
+import hashlib
+import tempfile
+
+DB_FILE = 'db.json'
+DATA_FILE = 'data.json'
+FILES_FOLDER = os.path.join('.', 'files')
+COLUMNS_CACHE_FOLDER = 'data-cache'
+READ_CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\r\n'
+
+
+class _Reader():
+    """ Buffered text reader for the incremental parser, the buffer only holds the unparsed part
+    """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Next non whitespace character, None at the end of the file
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, characters):
+        character = self.peek()
+        if character is None or character not in characters:
+            raise ValueError(f'expected one of {characters!r} at {self.pos}, got {character!r}')
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_items(path, chunk_size=READ_CHUNK_SIZE):
+    """ Yields (key, record) of a JSON object, or (index, record) of a JSON list, one record at a time
+    """
+    with open(path, encoding='utf-8') as f:
+        reader = _Reader(f, chunk_size)
+        opening = reader.expect('{[')
+        closing = '}' if opening == '{' else ']'
+        if reader.peek() == closing:
+            return
+
+        index = 0
+        while True:
+            if opening == '{':
+                key = reader.value()
+                reader.expect(':')
+            else:
+                key = index
+            yield key, reader.value()
+            index += 1
+            if reader.expect(',' + closing) == closing:
+                return
+
+
+def iter_records(path=DB_FILE, chunk_size=READ_CHUNK_SIZE):
+    """ Yields the books of db.json or data.json
+    """
+    for _, record in iter_items(path, chunk_size):
+        yield record
+
+
+def _columns_cache_file(path, columns):
+    key = hashlib.sha1(json.dumps(list(columns)).encode()).hexdigest()[:8]
+    folder = os.path.join(os.path.dirname(os.path.abspath(path)), COLUMNS_CACHE_FOLDER)
+    return os.path.join(folder, f'{os.path.basename(path)}.{key}.pickle')
+
+
+def load_columns(path=DB_FILE, columns=('id',), cache=True):
+    """ Dict column -> list of values for all the books, missing values are None. The columns are cached
+    and only parsed again when the size or the modification time of the file changed
+    """
+    columns = list(columns)
+    stat = os.stat(path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    cache_file = _columns_cache_file(path, columns)
+
+    if cache and os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['version'] == version:
+            return cached['columns']
+
+    result = {column: [] for column in columns}
+    for record in iter_records(path):
+        for column in columns:
+            result[column].append(record.get(column))
+
+    if cache:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # a temporary file of its own, processes started together may all rebuild the cache
+        handle, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_file))
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump({'version': version, 'columns': result}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    return result
+
+
+def load_ids(path=DB_FILE, cache=True):
+    return load_columns(path, ['id'], cache)['id']
+
+
+def list_files(folder=FILES_FOLDER):
+    """ Names of the files in the folder as a set, with a single directory scan
+    """
+    with os.scandir(folder) as entries:
+        return {x.name for x in entries if x.is_file()}
+
+
+def with_file(ids, folder=FILES_FOLDER):
+    """ The ids that have a file in the folder, in the same order
+    """
+    names = list_files(folder)
+    return [x for x in ids if str(x) in names]
+
+
+def shard_of(id, shards):
+    """ Shard of the book id, the same in every process and on every machine (unlike hash())
+    """
+    return zlib.crc32(str(id).encode()) % shards
@@ -0,0 +1,318 @@
+# Headless version of the catboost notebooks: trains the predictor on the local files, caches the
+# cross-validation by a fingerprint of the features, saves the model and writes result.json. The tags
+# are dense columns like in the notebooks, sparse columns or a hashed embedding feature (--tags), the cover
+# embeddings of embed.py can be added as an embedding feature (--embeddings)
+
+import numpy as np
+import pandas as pd
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from catboost import CatBoostClassifier, Pool, cv
+from catboost.utils import eval_metric
+import embedding_store
+import features
+import shared
+
+DATA_FILE = shared.DB_FILE
+COVERS_FILE = 'cover-score.json'
+MAPPING_FILE = 'mapping.json'
+MODEL_FILE = 'predictor.cbm'
+CV_CACHE_FOLDER = os.path.join('.', 'cv-cache')
+RESULT_FILE = 'result.json'
+RESULT_SIZE = 20
+EMBEDDING_COLUMN = 'cover-embedding'
+BENCHMARK_FILE = 'predictor-bench.json'
+BENCHMARK_ITERATIONS = 1000
+# Share of the labeled books the benchmark keeps out of the training for the AUC
+BENCHMARK_HOLDOUT = 0.2
+# Reuse the last iteration count instead of a new cross-validation while the new labels are below this share
+WARM_START_NEW_LABELS = 0.05
+
+PARAMETERS = {
+    'eval_metric': 'AUC',
+    'loss_function': 'Logloss',
+    'verbose': 100,
+    'random_seed': 42,
+    'learning_rate': 0.01,
+}
+
+
+def vocabulary_file(model_file):
+    return os.path.splitext(model_file)[0] + '.vocabulary.json'
+
+
+# Only the columns of the features are read, the covers come from the covers file
+BOOK_COLUMNS = ['id', 'name', 'label', 'categories', 'tags', *[x for x in features.REGULAR_COLUMNS if x != 'cover']]
+
+
+def load_books(data_file):
+    # db.json is keyed by the book name, data.json is a list, both are streamed
+    return pd.DataFrame(shared.load_columns(data_file, BOOK_COLUMNS))
+
+
+def load_frame(data_file, covers_file=None, embeddings=None):
+    """ The books with their cover scores and, with the name of an embedding store, their cover embeddings
+    in the cover-embedding column. The books without a cover score or embedding are left out
+    """
+    full = load_books(data_file)
+    print('all entries', len(full))
+
+    if covers_file:
+        covers = pd.read_json(covers_file)
+        full = full.merge(covers, on='id')
+        full = full[full['cover'].notna()].copy()
+        print('entries with cover', len(full))
+
+    if embeddings:
+        # the rows come in the order of the ids
+        ids, matrix = embedding_store.load(embeddings, full['id'].values)
+        full = full[full['id'].isin(ids)].copy()
+        full[EMBEDDING_COLUMN] = list(np.asarray(matrix, dtype=np.float32))
+        print('entries with cover embedding', len(full))
+
+    return full
+
+
+def feature_matrix(full, vocabulary, regular_columns):
+    # the vocabularies saved before the layouts had only dense columns
+    tags = features.tag_frame(full, vocabulary, vocabulary.get('layout', 'dense'), vocabulary.get('hash_size', features.HASH_SIZE))
+    X = pd.concat([full[regular_columns], tags], axis=1)
+    if vocabulary.get('embeddings'):
+        X[EMBEDDING_COLUMN] = full[EMBEDDING_COLUMN]
+    return X
+
+
+def embedding_features(X):
+    return [x for x in [features.HASHED_TAGS_COLUMN, EMBEDDING_COLUMN] if x in X.columns]
+
+
+def fingerprint(X, y, parameters):
+    embedding = embedding_features(X)
+    sparse = [x for x in X.columns if isinstance(X[x].dtype, pd.SparseDtype)]
+    dense = [x for x in X.columns if x not in embedding and x not in sparse]
+    digest = hashlib.sha1()
+    digest.update(json.dumps([list(X.columns), parameters], sort_keys=True).encode())
+    digest.update(pd.util.hash_pandas_object(X[dense], index=False).values.tobytes())
+    if sparse:
+        matrix = X[sparse].sparse.to_coo().tocsr()
+        for part in [matrix.data, matrix.indices, matrix.indptr]:
+            digest.update(part.tobytes())
+    for column in embedding:
+        digest.update(np.stack(X[column].values).tobytes())
+    digest.update(np.asarray(y, dtype=np.int8).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def cross_validate(X, y, parameters, threads):
+    started = time.perf_counter()
+    cv_data = cv(
+        params={**parameters, 'thread_count': threads},
+        pool=Pool(data=X, label=y, embedding_features=embedding_features(X) or None),
+        fold_count=5,
+        partition_random_seed=42,
+        verbose=False,
+        early_stopping_rounds=200,
+    )
+    best = cv_data['test-AUC-mean'].idxmax()
+    result = {
+        'iterations': int(cv_data['iterations'][best]) + 1,
+        'auc': float(cv_data['test-AUC-mean'][best]),
+        'seconds': time.perf_counter() - started,
+    }
+    print('cv iterations', result['iterations'], 'auc', result['auc'], f"in {result['seconds']:.1f}s")
+    return result
+
+
+def choose_iterations(X, y, parameters, threads, cache_folder=CV_CACHE_FOLDER, force_cv=False):
+    """ Number of iterations from the cross-validation, cached by the fingerprint of the features and labels
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    key = fingerprint(X, y, parameters)
+    cache_file = os.path.join(cache_folder, key + '.json')
+    latest_file = os.path.join(cache_folder, 'latest.json')
+
+    if not force_cv and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            result = json.load(f)
+        print('cached cv', key, 'iterations', result['iterations'], 'auc', result['auc'])
+        return result['iterations']
+
+    if not force_cv and os.path.isfile(latest_file):
+        with open(latest_file) as f:
+            latest = json.load(f)
+        new_labels = len(y) - latest['labels']
+        # only for the same features and parameters, e.g. not after --tags, --covers or --embeddings changed
+        same = latest.get('columns') == list(X.columns) and latest.get('parameters') == parameters
+        if same and 0 <= new_labels < WARM_START_NEW_LABELS * latest['labels']:
+            print('warm start from cv', latest['fingerprint'], 'new labels', new_labels)
+            return latest['iterations']
+
+    result = cross_validate(X, y, parameters, threads)
+    result = {**result, 'fingerprint': key, 'labels': len(y), 'columns': list(X.columns), 'parameters': parameters}
+    for file in [cache_file, latest_file]:
+        with open(file, 'w') as f:
+            json.dump(result, f)
+    return result['iterations']
+
+
+def top_k(scores, k):
+    """ Indexes of the k highest scores, highest first, without sorting all the scores
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def result_names(names, mapping_file=MAPPING_FILE):
+    # accept.ts expects the anonymized names, db.json has the real ones
+    if not os.path.isfile(mapping_file):
+        return list(names)
+    with open(mapping_file) as f:
+        mapping = json.load(f)
+    return [mapping.get(name, name) for name in names]
+
+
+def build_features(full, args):
+    """ (vocabulary, feature matrix), the vocabulary also records the layout of the features for score.py
+    """
+    regular_columns = features.REGULAR_COLUMNS if args.covers else [x for x in features.REGULAR_COLUMNS if x != 'cover']
+    vocabulary = {
+        **features.build_vocabulary(full),
+        'regular': regular_columns,
+        'layout': args.tags,
+        'hash_size': args.hash_size,
+        'embeddings': args.embeddings,
+    }
+    return vocabulary, feature_matrix(full, vocabulary, regular_columns)
+
+
+def frame_mb(X):
+    embedding = embedding_features(X)
+    size = X.drop(columns=embedding).memory_usage(index=False).sum()
+    size += sum(np.stack(X[x].values).nbytes for x in embedding)
+    return size / 2 ** 20
+
+
+def benchmark_layout(args):
+    """ Time, memory and holdout AUC of a training with the --tags layout and a fixed number of iterations
+    """
+    from bench import peak_rss_mb
+
+    full = load_frame(args.data, args.covers, args.embeddings)
+    started = time.perf_counter()
+    _, X = build_features(full, args)
+    features_seconds = time.perf_counter() - started
+
+    labeled = full['label'].notna().values
+    X = X[labeled]
+    y = full['label'][labeled].astype(int).values
+    order = np.random.RandomState(42).permutation(len(y))
+    split = int(len(y) * (1 - BENCHMARK_HOLDOUT))
+    train_rows, test_rows = order[:split], order[split:]
+
+    model = CatBoostClassifier(**{**PARAMETERS, 'verbose': False}, iterations=BENCHMARK_ITERATIONS, thread_count=args.threads)
+    started = time.perf_counter()
+    model.fit(Pool(X.iloc[train_rows], y[train_rows], embedding_features=embedding_features(X) or None))
+    fit_seconds = time.perf_counter() - started
+    scores = model.predict_proba(X.iloc[test_rows])[:, 1]
+
+    return {
+        'layout': args.tags,
+        'embeddings': args.embeddings,
+        'columns': X.shape[1],
+        'feature_mb': frame_mb(X),
+        'features_seconds': features_seconds,
+        'fit_seconds': fit_seconds,
+        'auc': eval_metric(y[test_rows], scores, 'AUC')[0],
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def benchmark(args):
+    """ Runs benchmark_layout for every layout in its own process, so the peak memory is the one of the layout
+    """
+    results = []
+    for layout in features.TAG_LAYOUTS:
+        print('benchmark', layout)
+        command = [sys.executable, os.path.abspath(__file__), '--benchmark_child', '--tags', layout,
+                   '--data', args.data, '--covers', args.covers, '--threads', str(args.threads), '--hash_size', str(args.hash_size)]
+        if args.embeddings:
+            command += ['--embeddings', args.embeddings]
+        # the result is the last line of the output
+        process = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            print('failed', layout)
+            continue
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    # compared with the dense columns of the notebooks
+    dense = next((x for x in results if x['layout'] == 'dense'), None)
+    for result in results:
+        peak = f"peak {result['peak_rss_mb']:.1f} MB" if result['peak_rss_mb'] else 'peak unknown'
+        print(result['layout'], 'columns', result['columns'], f"features {result['feature_mb']:.1f} MB", peak,
+              f"fit {result['fit_seconds']:.1f}s", f"auc {result['auc']:.4f}")
+        if dense and result is not dense:
+            change = [f"time x{result['fit_seconds'] / dense['fit_seconds']:.2f}", f"auc {result['auc'] - dense['auc']:+.4f}"]
+            if result['peak_rss_mb'] and dense['peak_rss_mb']:
+                change.insert(0, f"memory x{result['peak_rss_mb'] / dense['peak_rss_mb']:.2f}")
+            print('  vs dense', ', '.join(change))
+    with open(BENCHMARK_FILE, 'w') as f:
+        json.dump({'iterations': BENCHMARK_ITERATIONS, 'results': results}, f, indent=2)
+    print('saved', BENCHMARK_FILE)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='Train predictor')
+    parser.add_argument('--data', default=DATA_FILE, help='db.json or data.json')
+    parser.add_argument('--covers', default=COVERS_FILE, help='cover scores, pass an empty value to train without them')
+    parser.add_argument('--tags', default='dense', choices=features.TAG_LAYOUTS, help='layout of the category and tag features')
+    parser.add_argument('--hash_size', type=int, default=features.HASH_SIZE, help='buckets of the hashed tags')
+    parser.add_argument('--embeddings', help='cover embeddings saved by embed.py (e.g. cover-cnn), used as an embedding feature')
+    parser.add_argument('--model', default=MODEL_FILE)
+    parser.add_argument('--result', default=RESULT_FILE)
+    parser.add_argument('--result_size', type=int, default=RESULT_SIZE)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--force_cv', action='store_true')
+    parser.add_argument('--benchmark', action='store_true', help=f'compare the memory, time and AUC of the layouts, saved to {BENCHMARK_FILE}')
+    parser.add_argument('--benchmark_child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args)
+        return 0
+    if args.benchmark_child:
+        print(json.dumps(benchmark_layout(args)))
+        return 0
+
+    full = load_frame(args.data, args.covers, args.embeddings)
+    vocabulary, X = build_features(full, args)
+    features.save_vocabulary(vocabulary, vocabulary_file(args.model))
+
+    labeled = full['label'].notna().values
+    y = full['label'][labeled].astype(int).values
+    print('labeled', len(y), 'positive', int(y.sum()))
+
+    iterations = choose_iterations(X[labeled], y, PARAMETERS, args.threads, force_cv=args.force_cv)
+
+    model = CatBoostClassifier(**PARAMETERS, iterations=iterations, thread_count=args.threads)
+    model.fit(Pool(X[labeled], y, embedding_features=embedding_features(X) or None))
+    model.save_model(args.model)
+    print('saved', args.model)
+
+    scores = model.predict_proba(X[~labeled])[:, 1]
+    top = top_k(scores, args.result_size)
+    with open(args.result, "w") as outfile:
+        json.dump(result_names(full['name'][~labeled].values[top]), outfile)
+    print('saved', args.result)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
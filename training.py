@@ -0,0 +1,119 @@
+# Options shared by vgg_train.py and eff_train.py. The fast mode (--fast) compiles the model with XLA, trains
+# in mixed precision where the hardware has fast half precision math, caches the decoded and preprocessed
+# covers after the first epoch and runs the augmentation in parallel in the tf.data pipeline. Every fit logs
+# its epoch times and images/sec, and saves them to train-speed.json to compare the fast and the normal runs
+
+import tensorflow as tf
+import os
+import sys
+import json
+import time
+import metrics
+
+SPEED_FILE = 'train-speed.json'
+SHUFFLE_BUFFER = 1000
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def cpu_has_bfloat16():
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = next((line for line in f if line.startswith('flags')), '').split()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def enable_mixed_precision():
+    """ mixed_float16 on a GPU, mixed_bfloat16 on a CPU with bfloat16 instructions, nothing elsewhere (float16
+    is emulated on the other CPUs, which is slower than float32). Must be called before the model is built
+    """
+    if tf.config.list_physical_devices('GPU'):
+        policy = 'mixed_float16'
+    elif cpu_has_bfloat16():
+        policy = 'mixed_bfloat16'
+    else:
+        print('no fast half precision on this machine, training in float32')
+        return None
+    tf.keras.mixed_precision.set_global_policy(policy)
+    print('mixed precision policy', policy)
+    return policy
+
+
+def cache_file(path, subset):
+    """ The cache of the subset in the --cache_file path, '' (the memory) without a path
+    """
+    return f'{path}-{subset}' if path else ''
+
+
+def prepare(ds, preprocess, fast, augment=None, shuffle=False, cache=None):
+    """ The batches of ds preprocessed (and augmented), shuffled and prefetched. The fast mode preprocesses in
+    parallel and caches the preprocessed batches in memory (or in the cache file), the augmentation runs after
+    the cache so it still differs on every epoch
+    """
+    ds = ds.map(preprocess, num_parallel_calls=AUTOTUNE if fast else None)
+    if fast and cache is not None:
+        ds = ds.cache(cache)
+    if augment is not None:
+        ds = ds.map(augment, num_parallel_calls=AUTOTUNE)
+    if shuffle:
+        ds = ds.shuffle(SHUFFLE_BUFFER)
+    return ds.prefetch(buffer_size=AUTOTUNE)
+
+
+class SpeedLog(tf.keras.callbacks.Callback):
+    """ Prints the time and the images/sec of every epoch, saves the summary of the fit as
+    train-speed.json[name][mode] and prints the speedup over the other mode when it was run before
+    """
+
+    def __init__(self, name, mode, batch_size, path=SPEED_FILE):
+        super().__init__()
+        self.name = name
+        self.mode = mode
+        self.batch_size = batch_size
+        self.path = path
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.started = time.perf_counter()
+        self.batches = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self.started
+        # the last batch may be smaller
+        images = self.batches * self.batch_size
+        self.epochs.append((seconds, images))
+        if metrics.enabled:
+            metrics.add_time('epoch', seconds, images)
+        print(f'epoch {epoch + 1}: {seconds:.1f}s, {images / seconds:.1f} images/sec', file=sys.stderr)
+
+    def on_train_end(self, logs=None):
+        if not self.epochs:
+            return
+        # the first epoch also traces and compiles the model, and fills the cache
+        steady = self.epochs[1:] or self.epochs
+        seconds = sum(x for x, _ in steady)
+        summary = {
+            'epochs': len(self.epochs),
+            'first_epoch_seconds': self.epochs[0][0],
+            'epoch_seconds': seconds / len(steady),
+            'images_per_sec': sum(x for _, x in steady) / seconds,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+        speeds = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                speeds = json.load(f)
+        entry = speeds.setdefault(self.name, {})
+        entry[self.mode] = summary
+        with open(self.path, 'w') as f:
+            json.dump(speeds, f, indent=4)
+
+        print(f"{self.name} {self.mode}: {summary['epoch_seconds']:.1f}s per epoch, {summary['images_per_sec']:.1f} images/sec")
+        for mode, other in entry.items():
+            if mode != self.mode:
+                print(f"{self.mode} vs {mode} ({other['date']}): {summary['images_per_sec'] / other['images_per_sec']:.2f}x images/sec")
@@ -1,71 +1,284 @@
-import tensorflow as tf
 import os
+import sys
 import json
-import base64
+import time
+import argparse
+import subprocess
+import numpy as np
 from tqdm import tqdm
+from score_store import open_store, shard_file, merge_shards, STORE_FILE
+from cover_cache import CoverCache, model_fingerprint, CACHE_FILE
+from cover_store import open_covers, COVERS_FOLDER
+import shared
+import cover_model
+import metrics
+
+parser = argparse.ArgumentParser(prog='VGG run')
+parser.add_argument('--store', default=STORE_FILE)
+parser.add_argument('--flush_every', type=int, default=10)
+parser.add_argument('--export', default='cover-score.json')
+parser.add_argument('--cache', default=CACHE_FILE)
+parser.add_argument('--covers', default=COVERS_FOLDER, help='packed covers, the base64 files are read when there are none')
+parser.add_argument('--model', default=cover_model.MODEL_FOLDER, help='saved model folder, e.g. the student of distill.py')
+parser.add_argument('--tflite', nargs='?', const='trained_binary_vgg.dynamic.tflite', help='score with a model converted by quantize.py')
+parser.add_argument('--signature', nargs='?', const=cover_model.SIGNATURE,
+                    help='score with the traced serving signature of the saved model instead of the Keras model, faster to load')
+parser.add_argument('--threads', type=int, help='threads of the model and of the decoding, of every worker with --workers')
+parser.add_argument('--seed_cache', action='store_true', help='trust the stored scores when the cache has nothing for the model yet')
+parser.add_argument('--shards', type=int, help='split the covers into this many shards by a hash of the id')
+parser.add_argument('--shard', type=int, help='score only this shard (0 to shards - 1) into its own store')
+parser.add_argument('--workers', type=int, help='score all the shards with this many local processes, then merge them')
+parser.add_argument('--merge', action='store_true', help='merge the stores of the --shards shards and export the result')
+parser.add_argument('--cascade_model', help='cheap model (saved model folder or .tflite) scoring the covers first, e.g. from distill.py')
+parser.add_argument('--band', type=float, nargs=2, default=[0.2, 0.8], metavar=('LOW', 'HIGH'),
+                    help='covers with a cheap score in this range are scored again by the full model')
+parser.add_argument('--audit', type=int, default=200, help='covers outside the band also scored by the full model for the report')
+args = parser.parse_args()
+if args.workers:
+    args.shards = args.workers
+if (args.shard is not None or args.merge) and not args.shards:
+    parser.error('--shard and --merge need --shards')
+if args.shard is not None and not 0 <= args.shard < args.shards:
+    parser.error('--shard must be between 0 and shards - 1')
+if args.seed_cache and args.shards:
+    parser.error('run --seed_cache once without --shards')
+if args.signature and args.tflite:
+    parser.error('--signature is for saved models, not --tflite')
 
 FILES_FOLDER = os.path.join('.', 'files')
-IMAGE_SIZE = (224, 224)
-CHANNELS = 3
-IMAGE_SHAPE = (*IMAGE_SIZE, CHANNELS)
-BATCH_SIZE = 32
-RESULT_FILE = 'cover-score.json'
+BATCH_SIZE = cover_model.BATCH_SIZE
+RESULT_FILE = args.export
+FLUSH_EVERY = args.flush_every
+PREPROCESSING_VERSION = cover_model.PREPROCESSING_VERSION
+CASCADE_REPORT_FILE = 'cascade-report.json'
+# Score above which a cover counts as liked, for the agreement of the cascade
+DECISION_THRESHOLD = 0.5
 
-model = tf.keras.models.load_model(os.path.join('.', 'trained_binary_vgg'))
 
-def load_image(path):
-    with open(path) as f:
-        contents = f.read()
+def worker_command(shard, threads):
+    command = [sys.executable, os.path.abspath(__file__), '--shards', str(args.shards), '--shard', str(shard),
+               '--threads', str(threads), '--store', args.store, '--flush_every', str(FLUSH_EVERY),
+               '--cache', args.cache, '--covers', args.covers, '--model', args.model]
+    if args.cascade_model:
+        command += ['--cascade_model', args.cascade_model, '--band', *map(str, args.band), '--audit', str(args.audit)]
+    if args.signature:
+        command += ['--signature', args.signature]
+    return command + (['--tflite', args.tflite] if args.tflite else [])
 
-    # Decode from base64 string stored in file
-    content = base64.b64decode(contents)
-    img = tf.io.decode_image(content, channels=CHANNELS, expand_animations=False)
-    img = tf.image.resize(img, IMAGE_SIZE)
-    img.set_shape(IMAGE_SHAPE)
-    return img
 
+if args.workers:
+    # the new covers are packed and the ids are cached once here, the workers only read them
+    open_covers(args.covers, FILES_FOLDER).close()
+    shared.load_ids(shared.DB_FILE)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    print('starting', args.workers, 'workers with', threads, 'threads each')
+    workers = [subprocess.Popen(worker_command(shard, threads)) for shard in range(args.workers)]
+    failed = [shard for shard, worker in enumerate(workers) if worker.wait() != 0]
+    if failed:
+        # the finished shards are not scored again, the cache already has their scores
+        print('failed shards', failed, 'run again to resume them')
+        sys.exit(1)
 
-def predict(paths):
-    images = [load_image(path) for path in paths]
-    img_ds = tf.data.Dataset.from_tensor_slices(images)
-    img_ds = img_ds.batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
-    return model.predict(img_ds, verbose=0)  # shape: (N, 1)
+if args.workers or args.merge:
+    with open_store(args.store, RESULT_FILE) as store:
+        print('merged scores', merge_shards(store, args.store, args.shards))
+        print('exported', store.export_json(RESULT_FILE))
+    sys.exit(0)
 
+metrics.start_profile('vgg_run' if args.shard is None else f'vgg_run-shard-{args.shard}')
 
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
 
+def load_model(path, signature=None):
+    # TensorFlow and the model are only loaded when there are covers to score
+    with metrics.timer('load model'):
+        return cover_model.load_scorer(path, args.threads, signature)
 
-with open('./db.json') as f:
-    db = json.load(f)
 
-ids = [x.get('id') for x in db.values()]
+with metrics.timer('load ids'):
+    ids = shared.load_ids(shared.DB_FILE)
 print('all entries', len(ids))
-ids = [x for x in ids if os.path.isfile(os.path.join(FILES_FOLDER, str(x)))]
+with metrics.timer('open covers'):
+    covers = open_covers(args.covers, FILES_FOLDER, pack=args.shard is None)
+ids = [x for x in ids if x in covers]
 print('entries with image', len(ids))
 
-result = []
-resultSet = set()
-if os.path.isfile(RESULT_FILE):
-    with open(RESULT_FILE) as f:
-        result = json.load(f)
-    resultSet = {entry['id'] for entry in result}
-
-for chunk in tqdm(list(chunks(ids, BATCH_SIZE))):
-    chunk = [x for x in chunk if x not in resultSet]
-    if not chunk:
-        continue
-
-    image_paths = [os.path.join(FILES_FOLDER, str(x)) for x in chunk]
-    prediction = predict(image_paths)
-
-    for idx, id in enumerate(chunk):
-        item = {
-            'id': id,
-            'cover': float(prediction[idx][0])  # ✅ single sigmoid output
-        }
-        result.append(item)
-
-with open(RESULT_FILE, "w") as outfile:
-    json.dump(result, outfile, indent=4)
+if args.shard is None:
+    store = open_store(args.store, RESULT_FILE)
+else:
+    ids = [x for x in ids if shared.shard_of(x, args.shards) == args.shard]
+    print('entries in shard', args.shard, len(ids))
+    store = open_store(shard_file(args.store, args.shard, args.shards), None)
+print('entries scored', len(store))
+
+cache = CoverCache(args.cache)
+model_path = args.tflite or args.model
+with metrics.timer('fingerprint'):
+    fingerprint = model_fingerprint(model_path)
+print('model fingerprint', fingerprint)
+
+with metrics.timer('hash', len(ids)):
+    hashes = covers.hashes(ids, cache)
+with metrics.timer('cache lookup', len(ids)):
+    cached = cache.get_many(set(hashes.values()), fingerprint, PREPROCESSING_VERSION)
+
+if not cached and args.seed_cache:
+    seed = [(hashes[x], [store.get(x)]) for x in ids if store.get(x) is not None]
+    print('seeding cache', len(seed))
+    cache.put_many(seed, fingerprint, PREPROCESSING_VERSION)
+    cache.commit()
+    cached = cache.get_many(set(hashes.values()), fingerprint, PREPROCESSING_VERSION)
+
+
+def update(id, score):
+    if store.get(id) is None or abs(store.get(id) - score) > 1e-6:
+        store.add(id, score)
+
+
+def write_cache(entries, fingerprint):
+    # one short transaction per window: the shard workers share the cache file and its single write lock,
+    # which must not be held while the model runs
+    if entries:
+        with metrics.timer('write', len(entries)):
+            cache.put_many(entries, fingerprint, PREPROCESSING_VERSION)
+            cache.commit()
+        entries.clear()
+
+
+def score_covers(scorer, pending, stage='model'):
+    """ Scores the covers in batches and caches the scores, yields (chunk, prediction) with prediction of shape (N, 1).
+    The covers that fail to decode are cached as FAILED, so the next runs skip them
+    """
+    started = time.perf_counter()
+    window = []
+    failed = []
+    scored = 0
+    # 'input' is the time the model waits for the decoded and resized covers
+    batches = metrics.timed('input', cover_model.iter_batches(covers, pending, BATCH_SIZE, scorer.image_size, args.threads, failed), lambda x: len(x[0]))
+    progress = tqdm(batches, total=(len(pending) + BATCH_SIZE - 1) // BATCH_SIZE,
+                    desc=None if args.shard is None else f'shard {args.shard}', position=args.shard)
+    for batch, (chunk, images) in enumerate(progress):
+        with metrics.timer(stage, len(chunk)):
+            prediction = scorer.predict(images)
+
+        window.extend((hashes[id], prediction[idx]) for idx, id in enumerate(chunk))
+        scored += len(chunk)
+        yield chunk, prediction
+
+        if (batch + 1) % FLUSH_EVERY == 0:
+            store.flush()
+            write_cache(window, scorer.fingerprint)
+    window.extend((hashes[id], cover_model.FAILED) for id in failed)
+    write_cache(window, scorer.fingerprint)
+    elapsed = time.perf_counter() - started
+    if scored:
+        print(f"scored {scored} images with the {stage} in {elapsed:.1f}s ({scored / elapsed:.1f} images/sec)")
+    if failed:
+        print('failed to decode', len(failed), 'covers, they are skipped until they change')
+        metrics.count('covers failed to decode', len(failed))
+
+
+def cascade_report(cheap_scores, uncertain, audit, full_scores):
+    def agreement(ids):
+        if not ids:
+            return None
+        return float(np.mean([(cheap_scores[x] >= DECISION_THRESHOLD) == (full_scores[x] >= DECISION_THRESHOLD) for x in ids]))
+
+    def difference(ids):
+        return float(np.mean([abs(cheap_scores[x] - full_scores[x]) for x in ids])) if ids else None
+
+    certain = len(cheap_scores) - len(uncertain)
+    audit_agreement = agreement(audit)
+    return {
+        'covers': len(cheap_scores),
+        'band': args.band,
+        # the covers in the band and the audited ones both took the full model
+        'full_model_share': (len(uncertain) + len(audit)) / len(cheap_scores) if cheap_scores else None,
+        'band_share': len(uncertain) / len(cheap_scores) if cheap_scores else None,
+        'audited': len(audit),
+        # the share of the covers outside the band where the cheap model decides like the full model
+        'audit_agreement': audit_agreement,
+        'audit_mean_abs_difference': difference(audit),
+        'band_agreement': agreement(uncertain),
+        # the covers in the band get the full score, the others agree as often as the audited ones
+        'estimated_agreement': (len(uncertain) + certain * audit_agreement) / len(cheap_scores) if audit_agreement is not None else None,
+    }
+
+
+# Covers scored before by the same model only need their score copied to the store, the ones that failed
+# to decode are skipped
+pending = []
+failed = 0
+for x in ids:
+    value = cached.get(hashes[x])
+    if value is None:
+        pending.append(x)
+    elif np.isnan(value[0]):
+        failed += 1
+    else:
+        update(x, float(value[0]))
+store.flush()
+if failed:
+    print('entries that failed to decode', failed)
+print('entries to score', len(pending))
+metrics.count('covers cached', len(ids) - len(pending))
+
+cascade = args.cascade_model and pending
+if cascade:
+    # The cheap model scores every pending cover, the ones it is sure about keep its score
+    cascade_fingerprint = model_fingerprint(args.cascade_model)
+    print('cascade model fingerprint', cascade_fingerprint)
+    cascade_cached = cache.get_many({hashes[x] for x in pending}, cascade_fingerprint, PREPROCESSING_VERSION)
+    cheap_scores = {x: float(cascade_cached[hashes[x]][0]) for x in pending if hashes[x] in cascade_cached}
+    cascade_pending = [x for x in pending if hashes[x] not in cascade_cached]
+    if cascade_pending:
+        for chunk, prediction in score_covers(load_model(args.cascade_model), cascade_pending, 'cascade model'):
+            cheap_scores.update((id, float(prediction[idx][0])) for idx, id in enumerate(chunk))
+    metrics.count('covers scored by the cascade model', len([x for x in cascade_pending if x in cheap_scores]))
+
+    # the covers that failed to decode have no cheap score (FAILED in the cache), the full model would fail
+    # on them as well, so they are cached as FAILED for it too
+    cheap_scores = {x: score for x, score in cheap_scores.items() if not np.isnan(score)}
+    broken = [x for x in pending if x not in cheap_scores]
+    if broken:
+        write_cache([(hashes[x], cover_model.FAILED) for x in broken], fingerprint)
+    pending = [x for x in pending if x in cheap_scores]
+    low, high = args.band
+    uncertain = [x for x in pending if low <= cheap_scores[x] <= high]
+    certain = [x for x in pending if not low <= cheap_scores[x] <= high]
+    # Only the covers the cheap model scored in this run are audited: the certain covers never get a full
+    # model score, so the older ones are pending on every run and would be audited again and again
+    scored_now = set(cascade_pending)
+    candidates = [x for x in certain if x in scored_now]
+    audit = [candidates[i] for i in np.sort(np.random.RandomState(0).choice(len(candidates), min(args.audit, len(candidates)), replace=False))]
+    audited = set(audit)
+    for x in certain:
+        if x not in audited:
+            update(x, cheap_scores[x])
+    pending = uncertain + audit
+    print('entries in the band', len(uncertain), 'audited', len(audit))
+
+full_scores = {}
+if pending:
+    for chunk, prediction in score_covers(load_model(model_path, args.signature), pending):
+        for idx, id in enumerate(chunk):
+            store.add(id, float(prediction[idx][0]))  # ✅ single sigmoid output
+            full_scores[id] = float(prediction[idx][0])
+metrics.count('covers scored', len(full_scores))
+store.flush()
+cache.close()
+covers.close()
+
+# the report describes the covers the cheap model scored in this run, there is none without new covers
+if cascade and cascade_pending:
+    report = cascade_report({x: cheap_scores[x] for x in cascade_pending if x in cheap_scores}, [x for x in uncertain if x in scored_now], audit, full_scores)
+    for key, value in report.items():
+        print(key, value)
+    report_file = CASCADE_REPORT_FILE if args.shard is None else shard_file(CASCADE_REPORT_FILE, args.shard, args.shards)
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=4)
+# the shards are exported by --merge
+if args.shard is None and (store.changed or not os.path.isfile(RESULT_FILE)):
+    with metrics.timer('export'):
+        print('exported', store.export_json(RESULT_FILE))
+
+store.close()
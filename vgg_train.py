@@ -4,7 +4,24 @@
 
 import tensorflow as tf
 import os
+import argparse
 from tensorflow.keras.applications.vgg16 import preprocess_input
+import cover_tensors
+import feature_cache
+import metrics
+import training
+
+parser = argparse.ArgumentParser(prog='VGG train')
+parser.add_argument('--tensors', help='folder prepared by cover_tensors.py, used instead of the images folder')
+parser.add_argument('--cached_features', action='store_true', help='run the frozen VGG16 layers once and train the rest on the stored activations')
+parser.add_argument('--fast', action='store_true', help='XLA, mixed precision where supported and cached preprocessed covers')
+parser.add_argument('--cache_file', help='cache the covers of --fast in files with this prefix instead of the memory')
+args = parser.parse_args()
+
+metrics.start_profile('vgg_train')
+MODE = 'fast' if args.fast else 'baseline'
+if args.fast:
+    training.enable_mixed_precision()
 
 IMAGES_FOLDER = os.path.join('.', 'images')
 IMAGE_SIZE = (224, 224)
@@ -13,34 +30,36 @@ BATCH_SIZE = 32
 NUM_EPOCHS = 15
 
 # Load training and validation datasets
-train_ds = tf.keras.utils.image_dataset_from_directory(
-    IMAGES_FOLDER,
-    label_mode='binary',           # binary labels: 0.0 or 1.0
-    validation_split=0.2,
-    subset="training",
-    seed=42,
-    image_size=IMAGE_SIZE,
-    batch_size=BATCH_SIZE,
-)
-
-val_ds = tf.keras.utils.image_dataset_from_directory(
-    IMAGES_FOLDER,
-    label_mode='binary',
-    validation_split=0.2,
-    subset="validation",
-    seed=42,
-    image_size=IMAGE_SIZE,
-    batch_size=BATCH_SIZE,
-)
+if args.tensors:
+    train_ds, val_ds = cover_tensors.load_datasets(args.tensors, validation_split=0.2, seed=42, batch_size=BATCH_SIZE)
+else:
+    train_ds = tf.keras.utils.image_dataset_from_directory(
+        IMAGES_FOLDER,
+        label_mode='binary',           # binary labels: 0.0 or 1.0
+        validation_split=0.2,
+        subset="training",
+        seed=42,
+        image_size=IMAGE_SIZE,
+        batch_size=BATCH_SIZE,
+    )
 
-# Apply VGG16 preprocessing to datasets
-train_ds = train_ds.map(lambda x, y: (preprocess_input(x), y))
-val_ds = val_ds.map(lambda x, y: (preprocess_input(x), y))
+    val_ds = tf.keras.utils.image_dataset_from_directory(
+        IMAGES_FOLDER,
+        label_mode='binary',
+        validation_split=0.2,
+        subset="validation",
+        seed=42,
+        image_size=IMAGE_SIZE,
+        batch_size=BATCH_SIZE,
+    )
 
-# Optimize input pipeline
+# Apply VGG16 preprocessing and optimize the input pipeline, the prepared tensors are read from memory already
 AUTOTUNE = tf.data.AUTOTUNE
-train_ds = train_ds.shuffle(1000).prefetch(buffer_size=AUTOTUNE)
-val_ds = val_ds.prefetch(buffer_size=AUTOTUNE)
+preprocess = lambda x, y: (preprocess_input(x), y)
+train_ds = training.prepare(train_ds, preprocess, args.fast, shuffle=True,
+                            cache=None if args.tensors else training.cache_file(args.cache_file, 'train'))
+val_ds = training.prepare(val_ds, preprocess, args.fast,
+                          cache=None if args.tensors else training.cache_file(args.cache_file, 'val'))
 
 # Load VGG16 base model
 VGG16_features=tf.keras.applications.VGG16(input_shape=IMAGE_SHAPE,
@@ -60,28 +79,63 @@ model = tf.keras.Sequential([
     VGG16_features,
     tf.keras.layers.GlobalAveragePooling2D(),
     tf.keras.layers.Dense(64, activation='relu'),
-    tf.keras.layers.Dense(1, activation='sigmoid')  # binary output
+    tf.keras.layers.Dense(1, activation='sigmoid', dtype='float32')  # binary output, float32 with mixed precision
 ])
 
 # Compile for binary classification
 model.compile(
     optimizer=tf.keras.optimizers.Adam(),
     loss=tf.keras.losses.BinaryCrossentropy(),
-    metrics=["accuracy"]
+    metrics=["accuracy"],
+    jit_compile=args.fast
 )
 model.summary()
 
-# Train the model
-history = model.fit(
-    train_ds,
-    epochs=NUM_EPOCHS,
-    validation_data=val_ds
-)
+if args.cached_features:
+    # Everything before block5_conv3 is frozen, so its activations are the same on every epoch
+    frozen = tf.keras.Model(VGG16_features.input, VGG16_features.get_layer('block5_conv2').output)
+    source = args.tensors or IMAGES_FOLDER
+    with metrics.timer('features'):
+        train_features_ds = feature_cache.load_dataset(frozen, train_ds, 'vgg16-block5_conv2-train', source, BATCH_SIZE, shuffle=True)
+        val_features_ds = feature_cache.load_dataset(frozen, val_ds, 'vgg16-block5_conv2-val', source, BATCH_SIZE, shuffle=False)
+
+    # The tail shares its layers with the model, so the trained weights end up in the saved model
+    tail_input = tf.keras.layers.Input(shape=frozen.output_shape[1:])
+    x = VGG16_features.get_layer('block5_conv3')(tail_input)
+    x = VGG16_features.get_layer('block5_pool')(x)
+    for layer in model.layers[1:]:
+        x = layer(x)
+    tail = tf.keras.Model(tail_input, x)
+    tail.compile(
+        optimizer=tf.keras.optimizers.Adam(),
+        loss=tf.keras.losses.BinaryCrossentropy(),
+        metrics=["accuracy"],
+        jit_compile=args.fast
+    )
+
+    with metrics.timer('fit'):
+        history = tail.fit(
+            train_features_ds.prefetch(buffer_size=AUTOTUNE),
+            epochs=NUM_EPOCHS,
+            validation_data=val_features_ds.prefetch(buffer_size=AUTOTUNE),
+            callbacks=[training.SpeedLog('vgg_train cached_features', MODE, BATCH_SIZE)]
+        )
+else:
+    # Train the model
+    with metrics.timer('fit'):
+        history = model.fit(
+            train_ds,
+            epochs=NUM_EPOCHS,
+            validation_data=val_ds,
+            callbacks=[training.SpeedLog('vgg_train', MODE, BATCH_SIZE)]
+        )
 
 # Save trained model
-model.save(os.path.join('.', 'trained_binary_vgg'))
+with metrics.timer('save'):
+    model.save(os.path.join('.', 'trained_binary_vgg'))
 
 # Evaluate
-loss0, accuracy0 = model.evaluate(val_ds)
+with metrics.timer('evaluate'):
+    loss0, accuracy0 = model.evaluate(val_ds)
 print(f"loss: {loss0:.2f}")
 print(f"accuracy: {accuracy0:.2f}")